@@ -3,11 +3,38 @@
 import os
 import argparse
 import glob
+import itertools
+import multiprocessing
+
+import numpy as np
+
+from countsio import save_counts_matrix
+
+def count_clones(infilename,clone2id,chunksize=64*1024*1024):
+    """Count alignments per clone id, reading the file in large chunks
+
+    Clones missing from `clone2id` are ignored.
+    """
+    num_clones = len(clone2id)
+    counts = np.zeros(num_clones,dtype=np.int64)
+    with open(infilename,'r') as ip:
+        while True:
+            lines = ip.readlines(chunksize)
+            if not lines: break
+            ids = np.fromiter((clone2id.get(line.split('\t',3)[2].strip(),-1) for line in lines),dtype=np.int64,count=len(lines))
+            counts += np.bincount(ids[ids >= 0],minlength=num_clones)
+    return counts
+
+def count_sample(job):
+    (j,infilename) = job
+    return (j,count_clones(infilename,clone2id))
 
 argparser = argparse.ArgumentParser(description=None)
 argparser.add_argument('-i','--input',required=True)
 argparser.add_argument('-o','--output',required=True)
 argparser.add_argument('-r','--refcounts',required=True)
+argparser.add_argument('-b','--binary',action='store_true',help='write a binary counts matrix directory instead of CSV')
+argparser.add_argument('-j','--jobs',type=int,default=1,help='number of samples to count concurrently')
 args = argparser.parse_args()
 
 input_dir = os.path.abspath(args.input)
@@ -22,24 +49,35 @@ with open(reference_count_file,'r') as ip:
         data = line.split(',')
         reference_names.append(data[0].strip())
         reference_counts.append(int(data[1]))
+# dense integer id per clone name (repeated names share the first id)
+clone2id = {}
+for ref_clone in reference_names:
+    clone2id.setdefault(ref_clone,len(clone2id))
 
-# generate count dict
-samples = []
-counts = {}
-for infilename in glob.glob(os.path.join(input_dir,'*.aln')):
-    basename = '.'.join(os.path.basename(infilename).split('.')[:-1])
-    samples.append(basename)
-    counts[basename] = {}
-    with open(infilename,'r') as ip:
-        for line in ip:
-            ref_clone = line.split('\t')[2].strip()
-            counts[basename][ref_clone] = counts[basename].get(ref_clone,0) + 1
+# generate count matrix (samples x clones)
+infilenames = glob.glob(os.path.join(input_dir,'*.aln'))
+samples = ['.'.join(os.path.basename(infilename).split('.')[:-1]) for infilename in infilenames]
+counts = np.zeros((len(infilenames),len(clone2id)),dtype=np.int64)
+# start the largest samples first so no worker is left with one at the end
+jobs = sorted(enumerate(infilenames),key=lambda job: os.path.getsize(job[1]),reverse=True)
+if args.jobs <= 1:
+    results = itertools.imap(count_sample,jobs)
+else:
+    pool = multiprocessing.Pool(args.jobs)
+    results = pool.imap_unordered(count_sample,jobs)
+for (j,sample_counts) in results:
+    counts[j] = sample_counts
+if args.jobs > 1:
+    pool.close()
+    pool.join()
 
 # output counts
-with open(output_file,'w') as op:
-    print >>op, '# ' + ','.join(["ref_clone","ref_input"]+samples)  # header line
-    for (ref_clone,ref_count) in zip(reference_names,reference_counts):
-        record = [ref_clone,str(ref_count)]
-        for sample in samples:
-            record.append(str(counts[sample].get(ref_clone,0)))
-        print >>op, ','.join(record)
+clone_ids = [clone2id[ref_clone] for ref_clone in reference_names]
+if args.binary:
+    save_counts_matrix(output_file,reference_names,reference_counts,samples,counts[:,clone_ids])
+else:
+    with open(output_file,'w') as op:
+        print >>op, '# ' + ','.join(["ref_clone","ref_input"]+samples)  # header line
+        for (ref_clone,ref_count,clone_counts) in itertools.izip(reference_names,reference_counts,counts.T[clone_ids]):
+            record = [ref_clone,str(ref_count)] + map(str,clone_counts.tolist())
+            print >>op, ','.join(record)
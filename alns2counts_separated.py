@@ -3,17 +3,47 @@
 import os
 import argparse
 import glob
+import multiprocessing
+
+from countsio import save_counts_matrix
+from manifest import Manifest
+
+sample_name = lambda f: '.'.join(os.path.basename(f).split('.')[:-1])
+
+def count_sample(infilename):
+    counts = {}
+    sample = sample_name(infilename)
+    with open(infilename,'r') as ip:
+        for line in ip:
+            ref_clone = line.split('\t')[2].strip()
+            counts[ref_clone] = counts.get(ref_clone,0) + 1
+    
+    # output counts
+    output_file = os.path.join(output_dir,sample+suffix)
+    if args.binary:
+        save_counts_matrix(output_file,reference_names,reference_counts,[sample],[[counts.get(ref_clone,0) for ref_clone in reference_names]])
+        return
+    with open(output_file,'w') as op:
+        print >>op, '# ' + ','.join(["ref_clone","ref_input",sample])  # header line
+        for (ref_clone,ref_count) in zip(reference_names,reference_counts):
+            record = [ref_clone,str(ref_count),str(counts.get(ref_clone,0))]
+            print >>op, ','.join(record)
 
 argparser = argparse.ArgumentParser(description=None)
 argparser.add_argument('-i','--input',required=True)
 argparser.add_argument('-o','--output',required=True)
 argparser.add_argument('-r','--refcounts',required=True)
+argparser.add_argument('-b','--binary',action='store_true',help='write binary <sample>.mat counts matrices instead of CSV')
+argparser.add_argument('-j','--jobs',type=int,default=1,help='number of samples to count concurrently')
+argparser.add_argument('-u','--update',action='store_true',help='reuse the output directory and only recount samples whose inputs changed')
 args = argparser.parse_args()
 
 input_dir = os.path.abspath(args.input)
 output_dir = os.path.abspath(args.output)
-os.makedirs(output_dir,mode=0755)
-reference_count_file = args.refcounts
+if not (args.update and os.path.isdir(output_dir)):
+    os.makedirs(output_dir,mode=0755)
+reference_count_file = os.path.abspath(args.refcounts)
+suffix = '.mat' if args.binary else '.csv'
 
 # load reference counts
 reference_names = []
@@ -24,19 +54,32 @@ with open(reference_count_file,'r') as ip:
         reference_names.append(data[0].strip())
         reference_counts.append(int(data[1]))
 
-# generate count dict
-for infilename in glob.glob(os.path.join(input_dir,'*.aln')):
-    counts = {}
-    sample = '.'.join(os.path.basename(infilename).split('.')[:-1])
-    with open(infilename,'r') as ip:
-        for line in ip:
-            ref_clone = line.split('\t')[2].strip()
-            counts[ref_clone] = counts.get(ref_clone,0) + 1
-    
-    # output counts
-    output_file = os.path.join(output_dir,"%s.csv" % sample)
-    with open(output_file,'w') as op:
-        print >>op, '# ' + ','.join(["ref_clone","ref_input",sample])  # header line
-        for (ref_clone,ref_count) in zip(reference_names,reference_counts):
-            record = [ref_clone,str(ref_count),str(counts.get(ref_clone,0))]
-            print >>op, ','.join(record)
+# skip samples that are up to date with the manifest of the previous run
+manifest = Manifest(os.path.join(output_dir,'manifest.json'))
+params = {'binary':args.binary}
+stage_files = lambda f: ([f,reference_count_file],[os.path.join(output_dir,sample_name(f)+suffix)])
+infilenames = glob.glob(os.path.join(input_dir,'*.aln'))
+if args.update:
+    stale = []
+    for infilename in infilenames:
+        (inputs,outputs) = stage_files(infilename)
+        if not manifest.is_current(sample_name(infilename),inputs,params,outputs):
+            stale.append(infilename)
+    infilenames = stale
+    print "Recounting %i samples" % len(infilenames)
+
+# count each sample; the largest go first so no worker is left with one at the end
+infilenames = sorted(infilenames,key=os.path.getsize,reverse=True)
+if args.jobs <= 1:
+    for infilename in infilenames:
+        count_sample(infilename)
+else:
+    pool = multiprocessing.Pool(args.jobs)
+    pool.map(count_sample,infilenames,chunksize=1)
+    pool.close()
+    pool.join()
+
+for infilename in infilenames:
+    (inputs,outputs) = stage_files(infilename)
+    manifest.record(sample_name(infilename),inputs,params,outputs)
+manifest.save()
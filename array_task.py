@@ -0,0 +1,32 @@
+#! /usr/bin/env python
+
+# Run one task of an array job submitted by scheduler.submit_array: every
+# command of the task file whose task number is the scheduler's array index
+# (SGE_TASK_ID or LSB_JOBINDEX), each logging to its own file
+
+import os
+import sys
+import argparse
+import subprocess
+
+argparser = argparse.ArgumentParser(description=None)
+argparser.add_argument('-f','--tasks',required=True)
+argparser.add_argument('-t','--task',type=int,default=None,help='task number (default: from the scheduler environment)')
+args = argparser.parse_args()
+
+task = args.task
+if task is None:
+    task = int(os.environ.get('SGE_TASK_ID') or os.environ['LSB_JOBINDEX'])
+
+failed = 0
+with open(args.tasks,'r') as ip:
+    for line in ip:
+        if line.startswith('#'): continue
+        (task_id,log_file,cmd) = line.rstrip('\n').split('\t',2)
+        if int(task_id) != task: continue
+        with open(log_file,'w') as op:
+            returncode = subprocess.call(cmd,shell=True,stdout=op,stderr=subprocess.STDOUT)
+        if returncode != 0:
+            sys.stderr.write("Command failed with exit code %i: %s\n" % (returncode,cmd)); sys.stderr.flush()
+            failed += 1
+sys.exit(1 if failed else 0)
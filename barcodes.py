@@ -0,0 +1,205 @@
+# Barcode matching shared by the demultiplexing scripts
+
+import re
+import sys
+import operator
+import itertools
+import collections
+
+bcre = re.compile(r'#(.*)/')
+
+def hamming(a,b):
+    return sum(itertools.imap(operator.ne,a,b))
+
+def segment_bounds(length,parts):
+    """Split range(length) into `parts` contiguous, near-equal segments"""
+    return [(j*length/parts,(j+1)*length/parts) for j in xrange(parts)]
+
+class BarcodeIndex(object):
+    """Match read barcodes to samples within a maximum Hamming distance
+
+    Barcodes are indexed by the pigeonhole principle: split into max_dist+1
+    segments, any barcode within max_dist mismatches of a read shares at least
+    one segment with it exactly, so only those candidates are compared.  A
+    read is assigned to the sample of its unique closest barcode; ties between
+    different samples are ambiguous and left unassigned.  Results are memoized
+    since the same read barcodes recur constantly.
+
+    Supports `index[bc]`, raising KeyError for unassigned barcodes.
+    """
+
+    def __init__(self, barcode2sample, max_dist=1, cache_size=1000000):
+        self.barcode2sample = barcode2sample
+        self.max_dist = max_dist
+        self.cache_size = cache_size
+        self.cache = {}
+        self.segments = self.build_segments(max_dist+1)
+
+    def build_segments(self, parts):
+        segments = {}
+        for bc in self.barcode2sample:
+            for (j,(start,end)) in enumerate(segment_bounds(len(bc),parts)):
+                segments.setdefault((len(bc),j,bc[start:end]),[]).append(bc)
+        return segments
+
+    def candidates(self, bc, segments, parts):
+        found = set()
+        for (j,(start,end)) in enumerate(segment_bounds(len(bc),parts)):
+            found.update(segments.get((len(bc),j,bc[start:end]),()))
+        return found
+
+    def lookup(self, bc):
+        """Return the sample for read barcode `bc`, or None"""
+        try:
+            return self.cache[bc]
+        except KeyError:
+            pass
+        sample = None
+        if bc is not None:
+            sample = self.barcode2sample.get(bc)
+            if sample is None and self.max_dist > 0:
+                best = self.max_dist + 1
+                matches = set()
+                for cand in self.candidates(bc,self.segments,self.max_dist+1):
+                    dist = hamming(bc,cand)
+                    if dist > self.max_dist:
+                        continue
+                    if dist < best:
+                        best = dist
+                        matches = set([self.barcode2sample[cand]])
+                    elif dist == best:
+                        matches.add(self.barcode2sample[cand])
+                if len(matches) == 1:
+                    sample = matches.pop()
+        if len(self.cache) < self.cache_size:
+            self.cache[bc] = sample
+        return sample
+
+    def __getitem__(self, bc):
+        sample = self.lookup(bc)
+        if sample is None:
+            raise KeyError(bc)
+        return sample
+
+    def collisions(self):
+        """Return pairs of barcodes of different samples whose neighborhoods overlap
+
+        These are pairs within 2*max_dist of each other, found with a
+        (2*max_dist+1)-segment pigeonhole index.
+        """
+        parts = 2*self.max_dist + 1
+        segments = self.build_segments(parts)
+        pairs = set()
+        for bc in self.barcode2sample:
+            for other in self.candidates(bc,segments,parts):
+                if self.barcode2sample[other] == self.barcode2sample[bc]:
+                    continue
+                if len(other) == len(bc) and hamming(bc,other) <= 2*self.max_dist:
+                    pairs.add(tuple(sorted([bc,other])))
+        return sorted(pairs)
+
+def load_barcodes(mapping_file,max_dist=1):
+    """Load a barcode<TAB>sample mapping file
+
+    Returns a BarcodeIndex matching reads within `max_dist` mismatches, and
+    the list of sample names in file order.  Barcode pairs whose
+    neighborhoods collide are reported on stderr; reads falling between them
+    are left unassigned.
+    """
+    barcode2sample = {}
+    samples = []
+    seen = set()
+    with open(mapping_file,'r') as ip:
+        for line in ip:
+            data = line.split()
+            bc = data[0].upper()
+            sample = data[1]
+            if barcode2sample.get(bc,sample) != sample:
+                raise ValueError("Barcode %s is mapped to both %s and %s" % (bc,barcode2sample[bc],sample))
+            barcode2sample[bc] = sample
+            if sample not in seen:
+                samples.append(sample)
+                seen.add(sample)
+    
+    index = BarcodeIndex(barcode2sample,max_dist)
+    collisions = index.collisions()
+    for (bc1,bc2) in collisions[:20]:
+        sys.stderr.write("Barcodes %s (%s) and %s (%s) differ by only %i mismatches\n" % (bc1,barcode2sample[bc1],bc2,barcode2sample[bc2],hamming(bc1,bc2)))
+    if len(collisions) > 0:
+        sys.stderr.write("%i colliding barcode pairs at distance %i; ambiguous reads will be dropped\n" % (len(collisions),max_dist)); sys.stderr.flush()
+    return (index,samples)
+
+def read_barcode(header):
+    """Extract the barcode from a FASTQ read header
+
+    Handles both Casava 1.8 headers (`@name 1:N:0:BARCODE`) and older ones
+    (`@name#BARCODE/1`); returns None if no barcode is found.
+    """
+    fields = header.split()
+    if len(fields) > 1:
+        return fields[1].split(':')[-1]
+    match = bcre.search(header)
+    if match is None:
+        return None
+    return match.group(1)
+
+class SampleWriter(object):
+    """Buffer output per sample and write it out in large blocks
+
+    Buffered data is flushed (largest samples first) whenever the total
+    exceeds `buffer_size` bytes, and at most `max_open` file handles are kept
+    open at once (the least recently used is closed), so runs with thousands
+    of samples stay well below the open-file ulimit.
+    """
+
+    def __init__(self, filenames, buffer_size=256*1024*1024, max_open=128, opener=open):
+        """`filenames` maps each sample name to its output file"""
+        self.filenames = filenames
+        self.buffer_size = buffer_size
+        self.max_open = max_open
+        self.opener = opener
+        self.buffers = dict((sample, []) for sample in filenames)
+        self.sizes = dict((sample, 0) for sample in filenames)
+        self.total = 0
+        self.handles = collections.OrderedDict()
+        self.started = set()
+
+    def write(self, sample, data):
+        self.buffers[sample].append(data)
+        self.sizes[sample] += len(data)
+        self.total += len(data)
+        if self.total > self.buffer_size:
+            for sample in sorted(self.sizes, key=self.sizes.get, reverse=True):
+                self.flush_sample(sample)
+                if self.total <= self.buffer_size / 2:
+                    break
+
+    def handle(self, sample):
+        if sample in self.handles:
+            op = self.handles.pop(sample)
+        else:
+            if len(self.handles) >= self.max_open:
+                self.handles.popitem(last=False)[1].close()
+            mode = 'a' if sample in self.started else 'w'
+            op = self.opener(self.filenames[sample], mode=mode)
+            self.started.add(sample)
+        self.handles[sample] = op
+        return op
+
+    def flush_sample(self, sample):
+        if self.sizes[sample] == 0:
+            return
+        self.handle(sample).write(''.join(self.buffers[sample]))
+        self.total -= self.sizes[sample]
+        self.buffers[sample] = []
+        self.sizes[sample] = 0
+
+    def close(self):
+        """Flush everything and close all files (creating empty ones too)"""
+        for sample in self.filenames:
+            self.flush_sample(sample)
+            if sample not in self.started:
+                self.handle(sample)
+        for op in self.handles.itervalues():
+            op.close()
+        self.handles.clear()
@@ -0,0 +1,29 @@
+# bowtie invocation shared by every script that aligns reads, so that parts,
+# virtual parts, the exact-match pre-aligner, streaming and the pipeline all
+# align with the same options
+
+import os
+
+bowtie_options = ['-n','3','-l','100','--best','--nomaqround','--norc','-k','1','--quiet']
+
+def bowtie_env(index):
+    """Environment for bowtie to find `index` (path to its .ebwt prefix) by name"""
+    return dict(os.environ,BOWTIE_INDEXES=os.path.dirname(os.path.abspath(index)))
+
+def bowtie_command(index,reads,alignments=None,threads=None):
+    """bowtie's argument list; run it with bowtie_env(index)
+
+    `reads` may be '-' for stdin; without `alignments` they go to stdout.
+    """
+    cmd = ['bowtie'] + bowtie_options
+    if threads is not None:
+        cmd += ['-p',str(threads)]
+    cmd += [os.path.basename(index),reads]
+    if alignments is not None:
+        cmd.append(alignments)
+    return cmd
+
+def bowtie_shell_command(index,reads,alignments):
+    """bowtie_command as a shell command line that sets BOWTIE_INDEXES itself"""
+    index_dir = os.path.dirname(os.path.abspath(index))
+    return 'BOWTIE_INDEXES=%s %s' % (index_dir,' '.join(bowtie_command(index,reads,alignments)))
@@ -1,36 +1,14 @@
 #! /usr/bin/env python
 
 import os
+import sys
+import json
 import argparse
 import glob
-import subprocess
-
-def submit_to_LSF(queue,LSFopfile,cmd_to_submit,mem_usage=None):
-    # wrap command to submit in quotations
-    cmd_to_submit = r'"%s"' % cmd_to_submit.strip(r'"')
-    LSF_params = {'LSFoutput':LSFopfile,
-                      'queue':queue}
-    LSF_cmd = 'bsub -q%(queue)s -o%(LSFoutput)s' % LSF_params
-    if mem_usage != None:
-        LSF_cmd += r' -R "rusage[mem=%d]"' % mem_usage
-    cmd = ' '.join([LSF_cmd,cmd_to_submit])
-    p = subprocess.Popen(cmd,shell=True,stdout=subprocess.PIPE)
-    #p.wait()
-    return p.stdout.read().split('<')[1].split('>')[0]
-
-def submit_to_SGE(queue,log_file,cmd_to_submit,mem_usage=None):
-    # wrap command to submit in quotations
-    cmd_to_submit = r'"%s"' % cmd_to_submit.strip(r'"')
-    SGE_params = {'log_output':log_file,
-                      'queue':queue}
-    SGE_cmd = 'qsub -o %(log_output)s -m e -b y -V -j y -cwd -q %(queue)s -N bowtie_parts' % SGE_params
-    if mem_usage != None:
-        SGE_cmd += r' -l h_vmem=%dG' % mem_usage
-    cmd = ' '.join([SGE_cmd,cmd_to_submit])
-    print cmd
-    p = subprocess.Popen(cmd,shell=True,stdout=subprocess.PIPE)
-    #p.wait()
-    return p.stdout.read()
+
+from bowtie import bowtie_shell_command
+from oligos import load_prefix_hash, prefix_cache_file
+from scheduler import submit, submit_array, write_task_file
 
 argparser = argparse.ArgumentParser(description=None)
 argparser.add_argument('-i','--input',required=True)
@@ -38,6 +16,12 @@ argparser.add_argument('-o','--output',required=True)
 argparser.add_argument('-x','--index',required=True)
 argparser.add_argument('-l','--logs',required=True)
 argparser.add_argument('-q','--queue',required=True)
+argparser.add_argument('-S','--scheduler',choices=['SGE','LSF'],default='SGE')
+argparser.add_argument('-a','--array',action='store_true',help='submit all parts as one array job')
+argparser.add_argument('-k','--pack',type=int,default=1,help='number of parts aligned one after another by each array task')
+argparser.add_argument('-e','--exact',default=None,help='library oligo FASTA file; reads that exactly match an oligo skip bowtie')
+argparser.add_argument('--prefix',type=int,default=40,help='oligo prefix length hashed for --exact')
+argparser.add_argument('-m','--mem_usage',type=int,default=4,help='memory per job in GB (h_vmem on SGE, rusage[mem] on LSF)')
 args = argparser.parse_args()
 
 input_dir = os.path.abspath(args.input)
@@ -46,18 +30,61 @@ os.makedirs(output_dir,mode=0755)
 log_dir = os.path.abspath(args.logs)
 os.makedirs(log_dir,mode=0755)
 
-params = {
-    'index_dir'  : os.path.dirname(args.index),
-    'index_name' : os.path.basename(args.index)
-}
+bowtie_cmd = lambda reads,alignments: bowtie_shell_command(args.index,reads,alignments)
+script_dir = os.path.dirname(os.path.abspath(sys.argv[0]))
+range_cmd = 'python %(script_dir)s/bowtie_range.py -i %(reads)s -s %(offset)s -n %(length)s -x %(index)s -o %(alignments)s'
+
+# exact matches to the library are aligned by exact_align.py, which passes
+# only the remaining reads on to bowtie
+if args.exact is not None:
+    library_file = os.path.abspath(args.exact)
+    load_prefix_hash(library_file,args.prefix,prefix_cache_file(library_file,args.prefix))   # build the cache before the jobs start
+    exact_cmd = 'python %s/exact_align.py -l %s -k %i -x %s' % (script_dir,library_file,args.prefix,os.path.abspath(args.index))
+    bowtie_cmd = lambda reads,alignments: exact_cmd + ' -i %s -o %s' % (reads,alignments)
+    range_cmd = exact_cmd + ' -i %(reads)s -s %(offset)s -n %(length)s -o %(alignments)s'
+
+# parts sized by fastq2parts.py -a were planned for a number of concurrent
+# slots, which an array job then keeps to
+max_running = None
+sizing_file = os.path.join(input_dir,'parts.json')
+if os.path.exists(sizing_file):
+    with open(sizing_file,'r') as ip:
+        sizing = json.load(ip)
+    print "%s: %i parts of up to %i reads (%s sizing)" % (sizing['input'],sizing['parts'],sizing['packetsize'],sizing['mode'])
+    max_running = sizing['slots']
 
-bowtie_cmd = 'BOWTIE_INDEXES=%(index_dir)s bowtie -n 3 -l 100 --best --nomaqround --norc -k 1 --quiet %(index_name)s %(reads)s %(alignments)s'
+tasks = []   # (log file, command) for every part
 
-for infilename in glob.glob(os.path.join(input_dir,'*.fastq')):
-    basename = '.'.join(os.path.basename(infilename).split('.')[:-1])
+# virtual parts: each job streams its byte range of the original FASTQ file
+index_file = os.path.join(input_dir,'parts.idx')
+if os.path.exists(index_file):
+    with open(index_file,'r') as ip:
+        for line in ip:
+            if line.startswith('#'): continue
+            (basename,reads,offset,length,num_reads) = line.split('\t')
+            range_params = {'script_dir' : script_dir,
+                            'reads'      : reads,
+                            'offset'     : offset,
+                            'length'     : length,
+                            'index'      : os.path.abspath(args.index),
+                            'alignments' : os.path.join(output_dir,basename+'.aln')}
+            logfilename = os.path.join(log_dir,basename+'.log')
+            tasks.append((logfilename,range_cmd % range_params))
+
+# bowtie (>= 1.1.0) reads gzipped FASTQ directly, so compressed parts are
+# passed through as-is
+infilenames = glob.glob(os.path.join(input_dir,'*.fastq')) + glob.glob(os.path.join(input_dir,'*.fastq.gz'))
+for infilename in infilenames:
+    basename = os.path.basename(infilename).split('.fastq')[0]
     outfilename = os.path.join(output_dir,basename+'.aln')
     logfilename = os.path.join(log_dir,basename+'.log')
-    params['reads'] = infilename
-    params['alignments'] = outfilename
-    
-    print submit_to_SGE(args.queue,logfilename,bowtie_cmd % params,4)
+    tasks.append((logfilename,bowtie_cmd(infilename,outfilename)))
+
+if args.array:
+    if tasks:
+        task_file = os.path.join(log_dir,'bowtie_tasks.tsv')
+        num_tasks = write_task_file(task_file,tasks,args.pack)
+        print submit_array(args.scheduler,args.queue,log_dir,task_file,num_tasks,args.mem_usage,'bowtie_parts','-m e',max_running)
+else:
+    for (logfilename,cmd) in tasks:
+        print submit(args.scheduler,args.queue,logfilename,cmd,args.mem_usage,'bowtie_parts','-m e')
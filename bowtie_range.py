@@ -0,0 +1,33 @@
+#! /usr/bin/env python
+
+# Align a byte range of a FASTQ file (a "virtual part" from fastq2parts.py -v)
+# by streaming it into bowtie on stdin
+
+import os
+import sys
+import argparse
+import subprocess
+
+from bowtie import bowtie_command, bowtie_env
+
+argparser = argparse.ArgumentParser(description=None)
+argparser.add_argument('-i','--input',required=True)
+argparser.add_argument('-o','--output',required=True)
+argparser.add_argument('-x','--index',required=True)
+argparser.add_argument('-s','--offset',type=int,required=True)
+argparser.add_argument('-n','--length',type=int,required=True)
+argparser.add_argument('-b','--buffersize',type=int,default=16*1024*1024)
+args = argparser.parse_args()
+
+bowtie_cmd = bowtie_command(args.index,'-',os.path.abspath(args.output))
+p = subprocess.Popen(bowtie_cmd,stdin=subprocess.PIPE,env=bowtie_env(args.index))
+with open(args.input,'rb') as ip:
+    ip.seek(args.offset)
+    remaining = args.length
+    while remaining > 0:
+        chunk = ip.read(min(args.buffersize,remaining))
+        if not chunk: break
+        p.stdin.write(chunk)
+        remaining -= len(chunk)
+p.stdin.close()
+sys.exit(p.wait())
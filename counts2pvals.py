@@ -1,20 +1,31 @@
 #! /usr/bin/env python
 
+import os
 import sys
+import shutil
+import json
 import argparse
+import multiprocessing
 
 import numpy as np
+import pandas as pd
 import scipy as sp
 import scipy.optimize
+from scipy.special import gammaln
+
+from countsio import is_counts_matrix, load_counts_matrix, save_pvals_matrix
 
 argparser = argparse.ArgumentParser(description=None)
 argparser.add_argument('-i','--input',required=True)
 argparser.add_argument('-o','--output',required=True)
+argparser.add_argument('-s','--sf',choices=['table','tail'],default='table',help='compute survival functions from one table per (column,input count) or a separate tail sum per p-value')
+argparser.add_argument('-j','--jobs',type=int,default=1,help='number of worker processes (output columns are fit in parallel)')
+argparser.add_argument('--mle',choices=['batched','brentq'],default='batched',help='solve the lambda MLE for all input-count bins of a column at once, or one brentq per bin')
+argparser.add_argument('-b','--binary',action='store_true',help='write a binary p-value matrix directory instead of CSV')
+argparser.add_argument('--save-model',default=None,help='save the fitted per-column parameters to this file')
+argparser.add_argument('--model',default=None,help='skip fitting and score with parameters saved by --save-model')
 args = argparser.parse_args()
 
-inhandle = open(args.input,'r')
-outhandle = open(args.output,'w')
-
 lt1 = 1. - np.finfo(np.float64).epsneg
 
 def GP_lambda_likelihood(counts):
@@ -31,57 +42,182 @@ def GP_lambda_likelihood(counts):
     
     return lambda lam: sum(nx*(x*(x-1)/(x_bar+(x-x_bar)*lam))) - n*x_bar
 
+def GP_lambda_mle(bins,counts,num_bins,min_size=50,xtol=2e-12):
+    """Solve the lambda MLE of every bin of counts at once
+
+    `bins` gives the bin of each count.  The histogram of each bin is reduced
+    to its distinct (bin,count) pairs with their multiplicities, the
+    uniqueness condition is checked for all bins with array operations, and
+    the score equations of all bins are solved together by bisection on
+    [0,1).  Returns the lambdas and a mask of the bins that have at least
+    `min_size` counts and a unique root.
+    """
+    bins = np.asarray(bins,dtype=np.int64)
+    counts = np.asarray(counts,dtype=np.int64)
+    n = np.bincount(bins,minlength=num_bins)
+    x_bar = np.bincount(bins,weights=counts,minlength=num_bins) / np.maximum(n,1)
+    
+    # histogram sufficient statistics
+    width = counts.max() + 1
+    (keys,nx) = np.unique(bins*width + counts,return_counts=True)
+    (pair_bins,x) = (keys // width,keys % width)
+    w = nx * x * (x - 1.)
+    
+    # check condition for unique root
+    valid = (n >= min_size) & (np.bincount(pair_bins,weights=w,minlength=num_bins) - n*(x_bar**2) > 0)
+    keep = valid[pair_bins]
+    (pair_bins,x,w) = (pair_bins[keep],x[keep],w[keep])
+    pair_x_bar = x_bar[pair_bins]
+    
+    def H(lam):
+        with np.errstate(divide='ignore',invalid='ignore'):
+            terms = w / (pair_x_bar + (x - pair_x_bar)*lam[pair_bins])
+        return np.bincount(pair_bins,weights=terms,minlength=num_bins) - n*x_bar
+    
+    lo = np.zeros(num_bins)
+    hi = np.tile(lt1,num_bins)
+    valid &= H(hi) < 0  # a sign change is needed, as for brentq
+    while np.max(hi - lo) > xtol:
+        mid = (lo + hi) / 2
+        above = H(mid) > 0
+        lo = np.where(above,mid,lo)
+        hi = np.where(above,hi,mid)
+    return ((lo + hi) / 2,valid)
+
 def log_GP_pmf(x,theta,lambd):
+    """Log pmf of the generalized Poisson; x, theta and lambd broadcast"""
     log = np.log
-    logP = log(theta) + (x-1)*log(theta+x*lambd) - (theta+x*lambd) - np.sum(log(np.arange(1,x+1)))
+    logP = log(theta) + (x-1)*log(theta+x*lambd) - (theta+x*lambd) - gammaln(x+1)
     return logP
 
-def log_GP_sf(x,theta,lambd):
+def log_GP_sf(x,theta,lambd,batchsize=20000):
+    """Log survival function P(X > x) of the generalized Poisson
+
+    Takes arrays of x, theta and lambd (broadcast together) and sums the pmf
+    tail of every element at once, 100 terms at a time, until adding a block
+    no longer changes the sum (at most 20 blocks, otherwise NaN).
+    """
+    (x,theta,lambd) = [np.ravel(a) for a in np.broadcast_arrays(x,theta,lambd)]
+    if len(x) > batchsize:
+        return np.concatenate([log_GP_sf(x[k:k+batchsize],theta[k:k+batchsize],lambd[k:k+batchsize]) for k in xrange(0,len(x),batchsize)])
+    
     extensions = 20
-    start = x + 1
-    end = x + 100
-    pmf = [log_GP_pmf(y,theta,lambd) for y in xrange(start,end)]
+    result = np.empty(len(x))
+    result.fill(np.nan)
+    total = np.empty(len(x))
+    total.fill(-np.inf)
+    start = np.asarray(x,dtype=np.float64) + 1
+    width = 99
+    pending = np.arange(len(x))
+    while extensions > 0 and len(pending) > 0:
+        y = start[pending,np.newaxis] + np.arange(width)
+        pmf = log_GP_pmf(y,theta[pending,np.newaxis],lambd[pending,np.newaxis])
+        pmf[:,0] = np.logaddexp(total[pending],pmf[:,0])
+        accum = np.logaddexp.accumulate(pmf,axis=1)
+        done = accum[:,-1] == accum[:,-2]
+        result[pending[done]] = accum[done,-1]
+        total[pending] = accum[:,-1]
+        start[pending] += width
+        pending = pending[~done]
+        width = 100
+        extensions -= 1
+    return result
+
+def log_GP_sf_table(theta,lambd,max_x):
+    """Log survival function P(X > x) for every x in 0..max_x
+
+    The pmf is evaluated once up to max_x plus a tail, which is extended 100
+    terms at a time (at most 20 times) until it stops contributing, and a
+    reverse cumulative logaddexp gives every survival value in one pass.
+    Returns NaNs if the tail does not converge.
+    """
+    extensions = 20
+    pmf = [log_GP_pmf(np.arange(1,max_x+100),theta,lambd)]
+    tail_total = -np.inf
+    tail = pmf[0][max_x:]
     while extensions > 0:
-        accum = np.logaddexp.accumulate( pmf )
-        if accum[-1] == accum[-2]: return accum[-1]
-        start = end
-        end += 100
-        pmf += [log_GP_pmf(y,theta,lambd) for y in xrange(start,end)]
+        tail = np.logaddexp.accumulate(np.concatenate([[tail_total],tail]))
+        if tail[-1] == tail[-2]: break
+        tail_total = tail[-1]
+        start = max_x + 100*len(pmf)
+        tail = log_GP_pmf(np.arange(start,start+100),theta,lambd)
+        pmf.append(tail)
         extensions -= 1
-    # raise ValueError
-    return np.nan
+    else:
+        return np.tile(np.nan,max_x+1)
+    pmf = np.concatenate(pmf)
+    return np.logaddexp.accumulate(pmf[::-1])[::-1][:max_x+1]
+
 
+def compact_counts(counts,pseudocount):
+    """Copy counts into an int32 (if they fit) array and add the pseudocount in place"""
+    dtype = np.int32 if counts.size == 0 or counts.max() + pseudocount <= np.iinfo(np.int32).max else np.int64
+    compact = np.empty(counts.shape,dtype=dtype)
+    compact[:] = counts
+    compact += pseudocount
+    return compact
+
+def load_counts_csv(filename,pseudocount,chunksize=1000000):
+    """Parse a counts CSV in bulk into a preallocated compact matrix
+
+    Chunks are parsed by pandas' C reader and copied straight into an int32
+    matrix (upcast to int64 only if a count does not fit), so peak memory
+    stays close to the size of the matrix itself.
+    """
+    # upper bound on the number of rows; unused rows are never touched
+    num_lines = 1
+    num_header = 0
+    with open(filename,'rb') as ip:
+        for line in ip:
+            if not line.startswith('#'): break
+            num_header += 1
+        ip.seek(0)
+        for block in iter(lambda: ip.read(16*1024*1024),''):
+            num_lines += block.count('\n')
+    
+    clones = []
+    input_counts = np.empty(num_lines,dtype=np.int64)
+    output_counts = None
+    n = 0
+    reader = pd.read_csv(filename,header=None,skiprows=num_header,dtype={0:str},keep_default_na=False,na_filter=False,chunksize=chunksize)
+    for chunk in reader:
+        clones.extend(name.strip() for name in chunk[0])
+        input_counts[n:n+len(chunk)] = chunk[1].values
+        counts = chunk.iloc[:,2:].values
+        if output_counts is None:
+            output_counts = np.empty((num_lines,counts.shape[1]),dtype=np.int32)
+        if output_counts.dtype == np.int32 and counts.max() + pseudocount > np.iinfo(np.int32).max:
+            output_counts = output_counts.astype(np.int64)
+        output_counts[n:n+len(chunk)] = counts
+        output_counts[n:n+len(chunk)] += pseudocount
+        n += len(chunk)
+    return (clones,input_counts[:n],output_counts[:n])
 
 # Load data
 sys.stderr.write("Loading data...\n"); sys.stderr.flush()
-clones = []
-input_counts = []
-output_counts = []
-for line in inhandle:
-    if line.startswith('#'): continue
-    data = line.split(',')
-    clones.append( data[0].strip() )
-    input_counts.append( int(data[1]) )
-    output_counts.append( np.int_(data[2:]) )
-
-input_counts = np.asarray(input_counts)
-output_counts = np.asarray(output_counts) + 1   # pseudocounts to combat negative regressed theta
-uniq_input_values = list(set(input_counts))
+pseudocount = 1   # pseudocounts to combat negative regressed theta
+if is_counts_matrix(args.input):
+    (clones,input_counts,samples,counts) = load_counts_matrix(args.input)
+    input_counts = np.asarray(input_counts)
+    output_counts = compact_counts(counts.T,pseudocount)
+else:
+    (clones,input_counts,output_counts) = load_counts_csv(args.input,pseudocount)
+(uniq_input_values,input_bins) = np.unique(input_counts,return_inverse=True)
+# clones grouped by input count: group b is input_order[input_offsets[b]:input_offsets[b+1]]
+input_order = np.argsort(input_bins,kind='mergesort')
+input_offsets = np.r_[0,np.cumsum(np.bincount(input_bins))]
 sys.stderr.write("Num clones: %s\nInput vec shape: %s\nOutput array shape: %s\n" % (len(clones),input_counts.shape,output_counts.shape)); sys.stderr.flush()
 
-# Estimate generalized Poisson distributions for every input count
-sys.stderr.write("Computing lambdas and thetas for %i different input values...\n" % len(uniq_input_values)); sys.stderr.flush()
-lambdas = []
-thetas = []
-idxs = []
-for i in xrange(output_counts.shape[1]):    # for each output column...
-    sys.stderr.write("    working on output column %i\n" % i); sys.stderr.flush()
-    lambdas.append([])
-    thetas.append([])
-    idxs.append([])
-    for input_value in uniq_input_values:   # ...compute lambdas/thetas
+def estimate_column(i):
+    """Estimate lambda and theta for every input value in output column i"""
+    idxs = []
+    lambdas = []
+    thetas = []
+    sizes = []
+    column_counts = output_counts[input_order,i]
+    for (b,input_value) in enumerate(uniq_input_values):   # ...compute lambdas/thetas
         # compute lambda
-        curr_counts = output_counts[input_counts == input_value,i]
+        curr_counts = column_counts[input_offsets[b]:input_offsets[b+1]]
         if len(curr_counts) < 50:
             continue
         
@@ -90,51 +226,131 @@ for i in xrange(output_counts.shape[1]):    # for each output column...
         except ValueError:
             continue
         
-        idxs[-1].append(input_value)
+        idxs.append(input_value)
+        sizes.append(len(curr_counts))
         lambd = sp.optimize.brentq(H, 0., lt1)
-        lambdas[-1].append( lambd )
+        lambdas.append( lambd )
         
         # compute theta
         n = len(curr_counts)
         x_bar = sum(curr_counts) / float(n)
         theta =  x_bar * (1 - lambd)
-        thetas[-1].append( theta )
-
-# Regression on all of the theta and lambda values computed
-sys.stderr.write("Regression on lambdas and thetas...\n"); sys.stderr.flush()
-lambda_fits = []
-theta_fits = []
-for i in xrange(output_counts.shape[1]):
-    sys.stderr.write("    working on output column %i\n" % i); sys.stderr.flush()
-    lambda_fit = lambda x: np.mean(lambdas[i])
-    coeffs = np.polyfit(idxs[i],thetas[i],1)
-    theta_fit = lambda x: coeffs[0]*x + coeffs[1]
-    lambda_fits.append(lambda_fit)
-    theta_fits.append(theta_fit)
-
-# Precompute CDF for possible input-output combinations
-sys.stderr.write("Precomputing pval combos..."); sys.stderr.flush()
-uniq_combos = []
-for i in xrange(output_counts.shape[1]):
-    uniq_combos.append( set(zip(input_counts,output_counts[:,i])) )
-sys.stderr.write("computing %i combos\n" % sum([len(u) for u in uniq_combos])); sys.stderr.flush()
-log10pval_hash = {}
-j = 0
-for (i,u) in enumerate(uniq_combos):
-    for (ic,oc) in u:
-        if j % 1000 == 0: sys.stderr.write("...computed %i p-vals\n" % j); sys.stderr.flush()
-        log_pval = log_GP_sf(oc,theta_fits[i](ic),lambda_fits[i](ic))
-        log10pval_hash[(i,ic,oc)] = log_pval * np.log10( np.e ) * -1.
-        # pval = GP_sf(oc,theta_fits[i](ic),lambda_fits[i](ic))
-        # log10pval_hash[(i,ic,oc)] = -np.log10(pval)
-        j += 1
+        thetas.append( theta )
+    sys.stderr.write("    finished output column %i\n" % i); sys.stderr.flush()
+    return (idxs,lambdas,thetas,sizes)
+
+def estimate_column_batched(i):
+    """Estimate lambda and theta for every input value in output column i at once"""
+    curr_counts = output_counts[:,i]
+    (lambdas,valid) = GP_lambda_mle(input_bins,curr_counts,len(uniq_input_values))
+    sizes = np.bincount(input_bins,minlength=len(uniq_input_values))
+    x_bar = np.bincount(input_bins,weights=curr_counts,minlength=len(uniq_input_values)) / np.maximum(sizes,1)
+    thetas = x_bar * (1 - lambdas)
+    sys.stderr.write("    finished output column %i\n" % i); sys.stderr.flush()
+    return (list(uniq_input_values[valid]),list(lambdas[valid]),list(thetas[valid]),list(sizes[valid]))
+
+def column_log10pvals(job):
+    """Compute -log10 p-values for every clone of output column i
+
+    Each (input,output) combination is packed into one integer key, the
+    unique keys are scored once, and the results are gathered back to the
+    clones through the inverse index.
+    """
+    (i,lambd,coeffs) = job
+    curr_counts = output_counts[:,i].astype(np.int64)
+    width = curr_counts.max() + 1
+    (keys,inverse) = np.unique(input_bins*width + curr_counts,return_inverse=True)
+    (bins,ocs) = (keys // width,keys % width)
+    ics = uniq_input_values[bins]
+    log_pvals = np.empty(len(keys))
+    if args.sf == 'table':
+        # every p-value for one (column,input count) lies on a single pmf curve;
+        # keys are sorted, so each input count is one contiguous run
+        bounds = np.flatnonzero(np.diff(bins)) + 1
+        for (start,end) in zip(np.r_[0,bounds],np.r_[bounds,len(keys)]):
+            log_sf = log_GP_sf_table(np.polyval(coeffs,ics[start]),lambd,ocs[end-1])
+            log_pvals[start:end] = log_sf[ocs[start:end]]
+    else:
+        log_pvals[:] = log_GP_sf(ocs,np.polyval(coeffs,ics),lambd)
+    sys.stderr.write("    computed %i p-vals for output column %i\n" % (len(keys),i)); sys.stderr.flush()
+    return log_pvals[inverse] * np.log10( np.e ) * -1.
+
+# Columns are independent, so they are spread over worker processes.  The
+# workers are forked after the counts are loaded and read them through
+# copy-on-write shared memory; only column indices and fitted parameters are
+# sent to them.
+num_columns = output_counts.shape[1]
+if args.jobs > 1:
+    pool = multiprocessing.Pool(args.jobs)
+    parallel_map = lambda f, jobs: pool.map(f,jobs,chunksize=1)
+else:
+    parallel_map = map
+
+if args.model is not None:
+    # Load previously fitted parameters instead of estimating them
+    sys.stderr.write("Loading fitted parameters from %s...\n" % args.model); sys.stderr.flush()
+    with open(args.model,'r') as ip:
+        model = json.load(ip)
+    if len(model['columns']) != num_columns or model['pseudocount'] != pseudocount:
+        raise ValueError("Model %s was fitted on %i output columns (pseudocount %i), not %i" % (args.model,len(model['columns']),model['pseudocount'],num_columns))
+    lambda_means = [column['lambda_mean'] for column in model['columns']]
+    theta_coeffs = [np.asarray(column['theta_coeffs']) for column in model['columns']]
+else:
+    # Estimate generalized Poisson distributions for every input count
+    sys.stderr.write("Computing lambdas and thetas for %i different input values...\n" % len(uniq_input_values)); sys.stderr.flush()
+    if args.mle == 'batched':
+        (idxs,lambdas,thetas,sizes) = zip(*parallel_map(estimate_column_batched,range(num_columns)))
+    else:
+        (idxs,lambdas,thetas,sizes) = zip(*parallel_map(estimate_column,range(num_columns)))
+    
+    # Regression on all of the theta and lambda values computed
+    sys.stderr.write("Regression on lambdas and thetas...\n"); sys.stderr.flush()
+    lambda_means = []
+    theta_coeffs = []
+    for i in xrange(num_columns):
+        sys.stderr.write("    working on output column %i\n" % i); sys.stderr.flush()
+        lambda_means.append( np.mean(lambdas[i]) )
+        theta_coeffs.append( np.polyfit(idxs[i],thetas[i],1) )
+
+if args.save_model is not None:
+    model = {'pseudocount' : pseudocount,
+             'columns'     : []}
+    for i in xrange(num_columns):
+        column = {'lambda_mean'  : float(lambda_means[i]),
+                  'theta_coeffs' : map(float,theta_coeffs[i])}
+        if args.model is None:
+            column['bins'] = map(int,idxs[i])
+            column['bin_sizes'] = map(int,sizes[i])
+            column['lambdas'] = map(float,lambdas[i])
+            column['thetas'] = map(float,thetas[i])
+        model['columns'].append(column)
+    with open(args.save_model,'w') as op:
+        json.dump(model,op,indent=1,sort_keys=True)
 
 # Compute p-values for each clone using regressed GP parameters
-sys.stderr.write("Computing actual pvals...\n"); sys.stderr.flush()
-for (clone,ic,ocs) in zip(clones,input_counts,output_counts):
-    output_string = clone
-    for (i,oc) in enumerate(ocs): output_string += ",%f" % log10pval_hash[(i,ic,oc)]
-    print >>outhandle, output_string
+sys.stderr.write("Computing pvals for unique input-output combos...\n"); sys.stderr.flush()
+log10pvals = np.empty(output_counts.shape)
+for (i,column_log10pval) in enumerate(parallel_map(column_log10pvals,zip(range(num_columns),lambda_means,theta_coeffs))):
+    log10pvals[:,i] = column_log10pval
+if args.jobs > 1:
+    pool.close()
+    pool.join()
+
+# write to a temporary file that is only renamed into place once complete,
+# so a job killed while writing never leaves a partial output behind
+sys.stderr.write("Writing pvals...\n"); sys.stderr.flush()
+tmp_output = '%s.%i.tmp' % (args.output,os.getpid())
+if args.binary:
+    save_pvals_matrix(tmp_output,clones,log10pvals.T)
+    if os.path.isdir(args.output):
+        shutil.rmtree(args.output)
+else:
+    with open(tmp_output,'w') as outhandle:
+        blocksize = 100000
+        for start in xrange(0,len(clones),blocksize):
+            block = pd.DataFrame(log10pvals[start:start+blocksize],index=clones[start:start+blocksize])
+            block.to_csv(outhandle,header=False,float_format='%f',na_rep='nan')
+os.rename(tmp_output,args.output)
 
 # DEBUG
 # logpvals = np.asarray(logpvals)
@@ -4,54 +4,76 @@ import os
 import sys
 import argparse
 import glob
-import subprocess
-
-def submit_to_LSF(queue,LSFopfile,cmd_to_submit,mem_usage=None):
-    # wrap command to submit in quotations
-    cmd_to_submit = r'"%s"' % cmd_to_submit.strip(r'"')
-    LSF_params = {'LSFoutput':LSFopfile,
-                      'queue':queue}
-    LSF_cmd = 'bsub -q%(queue)s -o%(LSFoutput)s' % LSF_params
-    if mem_usage != None:
-        LSF_cmd += r' -R "rusage[mem=%d]"' % mem_usage
-    cmd = ' '.join([LSF_cmd,cmd_to_submit])
-    p = subprocess.Popen(cmd,shell=True,stdout=subprocess.PIPE)
-    #p.wait()
-    return p.stdout.read().split('<')[1].split('>')[0]
-
-def submit_to_SGE(queue,log_file,cmd_to_submit,mem_usage=None):
-    # wrap command to submit in quotations
-    cmd_to_submit = r'"%s"' % cmd_to_submit.strip(r'"')
-    SGE_params = {'log_output':log_file,
-                      'queue':queue}
-    SGE_cmd = 'qsub -o %(log_output)s -b y -V -j y -cwd -q %(queue)s -N counts2pval' % SGE_params
-    if mem_usage != None:
-        SGE_cmd += r' -l h_vmem=%dG' % mem_usage
-    cmd = ' '.join([SGE_cmd,cmd_to_submit])
-    print cmd
-    p = subprocess.Popen(cmd,shell=True,stdout=subprocess.PIPE)
-    #p.wait()
-    return p.stdout.read()
+from manifest import Manifest
+from scheduler import submit, submit_array, write_task_file, job_id, active_jobs
 
 argparser = argparse.ArgumentParser(description=None)
 argparser.add_argument('-i','--input',required=True)
 argparser.add_argument('-o','--output',required=True)
 argparser.add_argument('-q','--queue',required=True)
 argparser.add_argument('-l','--logs',required=True)
-argparser.add_argument('-m','--mem_usage',type=int,default=None)
+argparser.add_argument('-m','--mem_usage',type=int,default=None,help='memory per job in GB (h_vmem on SGE, rusage[mem] on LSF)')
+argparser.add_argument('-S','--scheduler',choices=['SGE','LSF'],default='SGE')
+argparser.add_argument('-a','--array',action='store_true',help='submit all samples as one array job')
+argparser.add_argument('-k','--pack',type=int,default=1,help='number of samples scored one after another by each array task')
+argparser.add_argument('-u','--update',action='store_true',help='reuse the output directory and only resubmit samples whose counts changed or whose p-values are missing')
 args = argparser.parse_args()
 
 input_dir = os.path.abspath(args.input)
 output_dir = os.path.abspath(args.output)
-os.makedirs(output_dir,mode=0755)
+if not (args.update and os.path.isdir(output_dir)):
+    os.makedirs(output_dir,mode=0755)
 log_dir = os.path.abspath(args.logs)
-os.makedirs(log_dir,mode=0755)
+if not (args.update and os.path.isdir(log_dir)):
+    os.makedirs(log_dir,mode=0755)
 
 script_dir = os.path.dirname(os.path.abspath(sys.argv[0]))
+manifest = Manifest(os.path.join(output_dir,'manifest.json'))
+params = {}
+tasks = []   # (log file, command) for every sample to score
+stage_files = []   # (sample, inputs, outputs) for every task
 
-for infilename in glob.glob(os.path.join(input_dir,'*.csv')):
+# with -u, samples whose job from an earlier run is still queued or running
+# are left alone rather than submitted a second time; if the queue cannot be
+# listed, no sample with a recorded job is resubmitted
+active = None
+if args.update:
+    active = active_jobs(args.scheduler)
+    if active is None:
+        sys.stderr.write("Could not list the %s queue; not resubmitting samples submitted by an earlier run\n" % args.scheduler); sys.stderr.flush()
+
+for infilename in glob.glob(os.path.join(input_dir,'*.csv')) + glob.glob(os.path.join(input_dir,'*.mat')):
     sample = '.'.join(os.path.basename(infilename).split('.')[:-1])
     outfilename = os.path.join(output_dir,'.'.join([sample,'pvals','csv']))
     logfilename = os.path.join(log_dir,'.'.join([sample,'pvals','log']))
+    if args.update and manifest.is_current(sample,[infilename],params,[outfilename]):
+        continue
+    job = manifest.entries.get(sample,{}).get('job')
+    if args.update and job is not None and (active is None or job in active):
+        print "%s: job %s may still be queued or running" % (sample,job)
+        continue
     cmd = 'python %s/counts2pvals.py -i %s -o %s' % (script_dir,os.path.abspath(infilename),os.path.abspath(outfilename))
-    print submit_to_SGE(args.queue,logfilename,cmd,mem_usage=args.mem_usage)
+    tasks.append((logfilename,cmd))
+    stage_files.append((sample,[infilename],[outfilename]))
+
+if args.array:
+    jobs = []
+    if tasks:
+        task_file = os.path.join(log_dir,'pvals_tasks.tsv')
+        num_tasks = write_task_file(task_file,tasks,args.pack)
+        output = submit_array(args.scheduler,args.queue,log_dir,task_file,num_tasks,args.mem_usage,'counts2pval')
+        print output
+        jobs = [job_id(args.scheduler,output)] * len(tasks)
+else:
+    jobs = []
+    for (logfilename,cmd) in tasks:
+        output = submit(args.scheduler,args.queue,logfilename,cmd,args.mem_usage,'counts2pval')
+        print output
+        jobs.append(job_id(args.scheduler,output))
+
+# counts2pvals.py only puts its output in place once it has succeeded, so a
+# recorded sample with a non-empty output is complete
+for ((sample,inputs,outputs),job) in zip(stage_files,jobs):
+    manifest.record(sample,inputs,params,outputs,job)
+
+manifest.save()
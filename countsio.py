@@ -0,0 +1,91 @@
+# Binary counts-matrix format shared by the counting and scoring scripts, and
+# the counts CSV writer of the scripts that count from alignments directly
+#
+# A counts matrix is a directory (by convention named *.mat) holding
+#
+#     clones.txt    clone names, one per line
+#     samples.txt   sample names, one per line
+#     input.npy     reference input count for each clone
+#     counts.npy    samples x clones count matrix
+#
+# The arrays are memory-mapped when loaded, and each sample's counts are
+# contiguous, so reading a few samples only touches their bytes.
+#
+# counts2pvals.py can write its -log10 p-values in the same layout, with
+# log10pvals.npy (columns x clones, float64) in place of the counts.
+
+import os
+import shutil
+
+import numpy as np
+
+def is_counts_matrix(path):
+    return os.path.isdir(path) and os.path.exists(os.path.join(path,'counts.npy'))
+
+def save_counts_matrix(path,clones,input_counts,samples,counts):
+    """Write a counts matrix directory, replacing any existing one
+
+    `counts` is samples x clones.
+    """
+    counts = np.asarray(counts)
+    assert counts.shape == (len(samples),len(clones))
+    if counts.size == 0 or counts.max() <= np.iinfo(np.int32).max:
+        counts = counts.astype(np.int32)
+    if is_counts_matrix(path):
+        shutil.rmtree(path)
+    os.makedirs(path,mode=0755)
+    with open(os.path.join(path,'clones.txt'),'w') as op:
+        op.write(''.join(clone+'\n' for clone in clones))
+    with open(os.path.join(path,'samples.txt'),'w') as op:
+        op.write(''.join(sample+'\n' for sample in samples))
+    np.save(os.path.join(path,'input.npy'),np.asarray(input_counts,dtype=np.int64))
+    np.save(os.path.join(path,'counts.npy'),np.ascontiguousarray(counts))
+
+def load_counts_matrix(path,mmap_mode='r'):
+    """Load a counts matrix directory
+
+    Returns (clones,input_counts,samples,counts) where the arrays are
+    memory-mapped read-only and `counts` is samples x clones.
+    """
+    with open(os.path.join(path,'clones.txt'),'r') as ip:
+        clones = ip.read().splitlines()
+    with open(os.path.join(path,'samples.txt'),'r') as ip:
+        samples = ip.read().splitlines()
+    input_counts = np.load(os.path.join(path,'input.npy'),mmap_mode=mmap_mode)
+    counts = np.load(os.path.join(path,'counts.npy'),mmap_mode=mmap_mode)
+    return (clones,input_counts,samples,counts)
+
+def write_counts_csv(path,reference_names,reference_counts,samples,counts):
+    """Write a counts CSV with one column per sample
+
+    `counts` maps each sample to a dict of clone -> count; clones missing
+    from it are written as 0.
+    """
+    with open(path,'w') as op:
+        print >>op, '# ' + ','.join(["ref_clone","ref_input"]+samples)  # header line
+        for (ref_clone,ref_count) in zip(reference_names,reference_counts):
+            record = [ref_clone,str(ref_count)]
+            for sample in samples:
+                record.append(str(counts[sample].get(ref_clone,0)))
+            print >>op, ','.join(record)
+
+def save_pvals_matrix(path,clones,log10pvals):
+    """Write a p-value matrix directory, replacing any existing one
+
+    `log10pvals` is columns x clones.
+    """
+    log10pvals = np.asarray(log10pvals,dtype=np.float64)
+    assert log10pvals.shape[1] == len(clones)
+    if os.path.exists(os.path.join(path,'log10pvals.npy')):
+        shutil.rmtree(path)
+    os.makedirs(path,mode=0755)
+    with open(os.path.join(path,'clones.txt'),'w') as op:
+        op.write(''.join(clone+'\n' for clone in clones))
+    np.save(os.path.join(path,'log10pvals.npy'),np.ascontiguousarray(log10pvals))
+
+def load_pvals_matrix(path,mmap_mode='r'):
+    """Load a p-value matrix directory as (clones,log10pvals), memory-mapped"""
+    with open(os.path.join(path,'clones.txt'),'r') as ip:
+        clones = ip.read().splitlines()
+    log10pvals = np.load(os.path.join(path,'log10pvals.npy'),mmap_mode=mmap_mode)
+    return (clones,log10pvals)
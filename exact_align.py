@@ -0,0 +1,89 @@
+#! /usr/bin/env python
+
+# Align the reads that exactly match the start of a library oligo without
+# bowtie: a hash from each oligo's first --prefix bases to its clone assigns
+# them in O(1), and they are written as bowtie-style alignment lines.  The
+# remaining reads are streamed into bowtie (-x) or written out (-u).
+
+import os
+import sys
+import argparse
+import shutil
+import subprocess
+
+from bowtie import bowtie_command, bowtie_env
+from fastqio import open_fastq, open_fastq_output, raw_fastq_records
+from oligos import load_prefix_hash, prefix_cache_file
+
+def byte_range(ip,length):
+    """Yield the lines of the next `length` bytes of a file"""
+    consumed = 0
+    for line in ip:
+        if consumed >= length: break
+        consumed += len(line)
+        yield line
+
+argparser = argparse.ArgumentParser(description=None)
+argparser.add_argument('-i','--input',required=True)
+argparser.add_argument('-o','--output',required=True)
+argparser.add_argument('-l','--library',required=True,help='FASTA file of the library oligos (as given to bowtie-build)')
+argparser.add_argument('-k','--prefix',type=int,default=40,help='number of leading bases hashed per oligo; shorter reads go to bowtie')
+argparser.add_argument('-c','--cache',default=None,help='prefix hash cache file (default: <library>.exact<prefix>.pkl)')
+argparser.add_argument('-x','--index',default=None,help='align the remaining reads with bowtie against this index')
+argparser.add_argument('-u','--unaligned',default=None,help='write the remaining reads to this FASTQ file instead')
+argparser.add_argument('-s','--offset',type=int,default=None,help='only read this byte range of the input (a virtual part)')
+argparser.add_argument('-n','--length',type=int,default=None)
+argparser.add_argument('-b','--buffersize',type=int,default=16*1024*1024)
+args = argparser.parse_args()
+
+if args.index is not None and args.unaligned is not None:
+    argparser.error('give at most one of -x/--index and -u/--unaligned')
+cache_file = args.cache if args.cache is not None else prefix_cache_file(args.library,args.prefix)
+prefix2oligo = load_prefix_hash(args.library,args.prefix,cache_file)
+
+if args.offset is not None:
+    ip = open(args.input,'r',args.buffersize)
+    ip.seek(args.offset)
+    lines = byte_range(ip,args.length)
+else:
+    ip = open_fastq(args.input,args.buffersize)
+    lines = ip
+
+# the remaining reads go to bowtie's stdin; its alignments are appended to
+# the output once the exact matches are written
+rest = None
+if args.index is not None:
+    bowtie_output = args.output + '.bowtie'
+    bowtie_cmd = bowtie_command(args.index,'-',bowtie_output)
+    p = subprocess.Popen(bowtie_cmd,stdin=subprocess.PIPE,env=bowtie_env(args.index),bufsize=args.buffersize)
+    rest = p.stdin
+elif args.unaligned is not None:
+    rest = open_fastq_output(args.unaligned,args.buffersize)
+
+num_reads = 0
+num_exact = 0
+prefix_len = args.prefix
+with open(args.output,'w',args.buffersize) as op:
+    for record in raw_fastq_records(lines):
+        num_reads += 1
+        (header,seq,plus,qual) = record
+        seq = seq.rstrip()
+        hit = prefix2oligo.get(seq[:prefix_len]) if len(seq) >= prefix_len else None
+        if hit is not None and hit[1].startswith(seq):
+            num_exact += 1
+            op.write('%s\t+\t%s\t0\t%s\t%s\t0\t\n' % (header[1:].rstrip(),hit[0],seq,qual.rstrip()))
+        elif rest is not None:
+            rest.write(''.join(record))
+ip.close()
+sys.stderr.write("%i of %i reads matched a library oligo exactly\n" % (num_exact,num_reads)); sys.stderr.flush()
+
+if args.index is not None:
+    rest.close()
+    if p.wait() != 0:
+        sys.exit(p.returncode)
+    with open(args.output,'a') as op:
+        with open(bowtie_output,'r') as ip:
+            shutil.copyfileobj(ip,op,args.buffersize)
+    os.remove(bowtie_output)
+elif rest is not None:
+    rest.close()
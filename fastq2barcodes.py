@@ -0,0 +1,54 @@
+#! /usr/bin/env python
+
+# Demultiplex reads by the barcode in their header before alignment, so that
+# reads matching no sample never reach bowtie
+
+import os
+import argparse
+
+from fastqio import open_fastq, open_fastq_output, raw_fastq_records
+from barcodes import load_barcodes, read_barcode, SampleWriter
+
+argparser = argparse.ArgumentParser(description=None)
+argparser.add_argument('-i','--input',required=True)
+argparser.add_argument('-o','--output',required=True)
+argparser.add_argument('-m','--mapping',required=True)
+argparser.add_argument('-d','--distance',type=int,default=1,help='maximum barcode mismatches')
+argparser.add_argument('-u','--unmatched',default=None,help='write reads matching no sample here instead of dropping them')
+argparser.add_argument('-z','--compress',action='store_true',help='write gzip-compressed <sample>.fastq.gz files')
+argparser.add_argument('-b','--buffersize',type=int,default=256*1024*1024,help='output buffer size in bytes')
+argparser.add_argument('-f','--maxfiles',type=int,default=128,help='maximum number of open output files')
+argparser.add_argument('-t','--threads',type=int,default=4,help='decompression threads for gzip/bgzip input')
+args = argparser.parse_args()
+
+input_filename = args.input
+output_dir = os.path.abspath(args.output)
+os.makedirs(output_dir,mode=0755)
+suffix = '.fastq.gz' if args.compress else '.fastq'
+
+# load barcode mapping
+(barcode2sample,samples) = load_barcodes(args.mapping,args.distance)
+filenames = dict((sample,os.path.join(output_dir,sample+suffix)) for sample in samples)
+unmatched = None
+if args.unmatched is not None:
+    unmatched = '__unmatched__'
+    filenames[unmatched] = args.unmatched
+writer = SampleWriter(filenames,args.buffersize,args.maxfiles,open_fastq_output)
+
+# iterate through reads
+num_reads = 0
+num_matched = 0
+for record in raw_fastq_records(open_fastq(input_filename,16*1024*1024,args.threads)):
+    num_reads += 1
+    try:
+        sample = barcode2sample[read_barcode(record[0])]
+    except KeyError:
+        if unmatched is not None:
+            writer.write(unmatched,''.join(record))
+        continue
+    writer.write(sample,''.join(record))
+    num_matched += 1
+
+writer.close()
+
+print "Assigned %i of %i reads to %i samples" % (num_matched,num_reads,len(samples))
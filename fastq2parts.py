@@ -1,36 +1,116 @@
 #! /usr/bin/env python
 
 import os
+import sys
+import json
+import math
 import argparse
 
-from Bio import SeqIO
+from fastqio import is_gzipped, open_fastq, open_fastq_output, raw_fastq_records, estimate_read_count
 
 argparser = argparse.ArgumentParser(description=None)
 argparser.add_argument('-i','--input',required=True)
 argparser.add_argument('-o','--output',required=True)
-argparser.add_argument('-p','--packetsize',type=int,required=True)
+argparser.add_argument('-p','--packetsize',type=int,default=None)
+argparser.add_argument('-s','--strict',action='store_true',help='parse and validate every read with Bio.SeqIO (slow)')
+argparser.add_argument('-b','--buffersize',type=int,default=16*1024*1024,help='I/O buffer size in bytes')
+argparser.add_argument('-t','--threads',type=int,default=4,help='decompression threads for gzip/bgzip input')
+argparser.add_argument('-z','--compress',action='store_true',help='write gzip-compressed parts (part.N.fastq.gz)')
+argparser.add_argument('-v','--virtual',action='store_true',help='write a byte-range index (parts.idx) into the original file instead of copying parts')
+argparser.add_argument('-a','--auto',action='store_true',help='choose the packet size from the estimated read count, --slots and --minutes')
+argparser.add_argument('--slots',type=int,default=100,help='number of alignment jobs expected to run at once (with -a)')
+argparser.add_argument('--minutes',type=float,default=30,help='target alignment time per part (with -a)')
+argparser.add_argument('--rate',type=int,default=250000,help='reads aligned per minute by one bowtie job (with -a)')
+argparser.add_argument('--minpacket',type=int,default=100000,help='smallest packet size chosen by -a, so bowtie index loading stays negligible')
 args = argparser.parse_args()
+if (args.packetsize is None) == (not args.auto):
+    argparser.error('give exactly one of -p/--packetsize and -a/--auto')
 
 input_filename = args.input
+if args.virtual and (args.compress or is_gzipped(input_filename)):
+    argparser.error('--virtual parts require an uncompressed input file')
 output_dir = os.path.abspath(args.output)
 os.makedirs(output_dir,mode=0755)
-packetsize = args.packetsize
+bufsize = args.buffersize
+
+# the sizing decision is recorded in parts.json, which bowtie_parts_with_LSF.py reads
+sizing = {'input':os.path.abspath(input_filename),'input_size':os.path.getsize(input_filename),'mode':'fixed','slots':None}
+if args.auto:
+    # fill every slot, with no part running longer than the target time;
+    # the part count is rounded up to whole waves of slots
+    (estimated_reads,bytes_per_read) = estimate_read_count(input_filename)
+    max_packetsize = max(int(args.rate * args.minutes),1)
+    num_parts = int(math.ceil(float(estimated_reads) / max_packetsize))
+    num_parts = int(math.ceil(float(num_parts) / args.slots)) * args.slots
+    packetsize = max(int(math.ceil(float(estimated_reads) / num_parts)),args.minpacket)
+    sizing.update({'mode':'auto','estimated_reads':estimated_reads,'bytes_per_read':bytes_per_read,
+                   'slots':args.slots,'minutes':args.minutes,'rate':args.rate,
+                   'estimated_parts':int(math.ceil(float(estimated_reads) / packetsize))})
+    sys.stderr.write("Estimated %i reads; splitting into parts of %i reads\n" % (estimated_reads,packetsize)); sys.stderr.flush()
+else:
+    packetsize = args.packetsize
+sizing['packetsize'] = packetsize
+
+def write_sizing(num_parts,num_reads):
+    sizing.update({'parts':num_parts,'reads':num_reads})
+    with open(os.path.join(output_dir,'parts.json'),'w') as op:
+        json.dump(sizing,op,indent=1,sort_keys=True)
+
+suffix = '.fastq.gz' if args.compress else '.fastq'
+ip = open_fastq(input_filename,bufsize,args.threads)
+
+if args.strict:
+    from Bio import SeqIO
+    records = (record.format('fastq') for record in SeqIO.parse(ip,'fastq'))
+else:
+    records = (''.join(record) for record in raw_fastq_records(ip))
+
+if args.virtual:
+    # scan the input once and record where each part starts and ends; the
+    # alignment jobs then stream their byte range from the original file
+    input_path = os.path.abspath(input_filename)
+    input_size = os.path.getsize(input_path)
+    parts = []
+    offset = 0
+    length = 0
+    num_processed = 0
+    for record in raw_fastq_records(ip):
+        length += sum(map(len,record))
+        num_processed += 1
+        if num_processed == packetsize:
+            parts.append((offset,length,num_processed))
+            offset += length
+            length = 0
+            num_processed = 0
+    if num_processed > 0:
+        # a missing final newline is counted by raw_fastq_records
+        parts.append((offset,min(length,input_size-offset),num_processed))
+    
+    with open(os.path.join(output_dir,'parts.idx'),'w') as op:
+        print >>op, '# ' + '\t'.join(['part','fastq','offset','length','reads'])  # header line
+        for (file_num,(offset,length,num_reads)) in enumerate(parts,1):
+            print >>op, '\t'.join(['part.%s' % file_num,input_path,str(offset),str(length),str(num_reads)])
+    write_sizing(len(parts),sum(part[2] for part in parts))
+    sys.exit()
 
 num_processed = 0
+num_reads = 0
 file_num = 1
-outfilename = os.path.join(output_dir,'part.%s.fastq' % file_num)
-for record in SeqIO.parse(input_filename,'fastq'):
+outfilename = os.path.join(output_dir,'part.%s%s' % (file_num,suffix))
+for record in records:
     if num_processed == 0:
-        op = open(outfilename,'w')
+        op = open_fastq_output(outfilename,bufsize)
     
-    op.write(record.format('fastq'))
+    op.write(record)
     num_processed += 1
+    num_reads += 1
     
     if num_processed == packetsize:
         op.close()
         num_processed = 0
         file_num += 1
-        outfilename = os.path.join(output_dir,'part.%s.fastq' % file_num)
+        outfilename = os.path.join(output_dir,'part.%s%s' % (file_num,suffix))
 
 if not op.closed:
     op.close()
+write_sizing(file_num if num_processed > 0 else file_num-1,num_reads)
@@ -0,0 +1,119 @@
+# Raw FASTQ reading/writing shared by the pipeline scripts
+
+import io
+import os
+import gzip
+import itertools
+import subprocess
+from distutils.spawn import find_executable
+
+def is_gzipped(filename):
+    with open(filename,'rb') as ip:
+        return ip.read(2) == '\x1f\x8b'
+
+def open_fastq(filename,bufsize=-1,threads=1):
+    """Open a plain, gzip or bgzip-compressed FASTQ file for reading
+
+    Compressed input is inflated by bgzip or pigz in a separate process when
+    either is on the PATH (bgzip decompresses BGZF blocks on multiple
+    threads); otherwise falls back to the gzip module.
+    """
+    if not is_gzipped(filename):
+        return open(filename,'r',bufsize)
+    with open(filename,'rb') as ip:
+        header = ip.read(18)
+    is_bgzf = ord(header[3]) & 4 and header[12:14] == 'BC'
+    if is_bgzf and find_executable('bgzip'):
+        cmd = ['bgzip','-dc','-@',str(threads),filename]
+    elif find_executable('pigz'):
+        cmd = ['pigz','-dc','-p',str(threads),filename]
+    else:
+        return io.BufferedReader(gzip.open(filename,'rb'),max(bufsize,io.DEFAULT_BUFFER_SIZE))
+    p = subprocess.Popen(cmd,stdout=subprocess.PIPE,bufsize=bufsize)
+    return DecompressorReader(p,cmd[0])
+
+class DecompressorReader(object):
+    """Read the output of a decompression process
+
+    Reaching the end of the stream waits for the process and raises IOError
+    if it failed (e.g. a CRC error or truncated input), so a damaged file is
+    never mistaken for a short one.
+    """
+
+    def __init__(self, p, name):
+        self.p = p
+        self.name = name
+        self.stdout = p.stdout
+
+    def check(self):
+        if self.p.wait() != 0:
+            raise IOError("%s failed with exit code %i" % (self.name,self.p.returncode))
+
+    def read(self, size=-1):
+        data = self.stdout.read(size)
+        if not data and size != 0:
+            self.check()
+        return data
+
+    def readline(self):
+        line = self.stdout.readline()
+        if not line:
+            self.check()
+        return line
+
+    def __iter__(self):
+        for line in self.stdout:
+            yield line
+        self.check()
+
+    def close(self):
+        self.stdout.close()
+        self.p.wait()
+
+def raw_fastq_records(handle):
+    """Yield each FASTQ record as a raw 4-line block (header,seq,plus,qual)
+
+    Only minimal validation is done; parse with Bio.SeqIO for strict checks.
+    """
+    lines = iter(handle)
+    for record in itertools.izip_longest(lines,lines,lines,lines,fillvalue=''):
+        (header,seq,plus,qual) = record
+        if not header.startswith('@') or not plus.startswith('+'):
+            raise ValueError("Malformed FASTQ record: %s" % header.strip())
+        if len(seq.rstrip()) != len(qual.rstrip()):
+            raise ValueError("Sequence and quality lengths differ: %s" % header.strip())
+        if not qual.endswith('\n'):
+            record = (header,seq,plus,qual+'\n')
+        yield record
+
+def estimate_read_count(filename,sample_size=10000):
+    """Estimate the number of reads in a FASTQ file from its first records
+
+    Returns (estimated reads, file bytes per read). For compressed files the
+    bytes per read are measured in compressed bytes, so the estimate holds
+    as long as the start of the file compresses like the rest.
+    """
+    file_size = os.path.getsize(filename)
+    if is_gzipped(filename):
+        ip = gzip.open(filename,'rb')
+        position = lambda: ip.fileobj.tell()
+    else:
+        ip = open(filename,'r')
+        position = lambda: sum(sizes)
+    sizes = []
+    try:
+        for record in itertools.islice(raw_fastq_records(ip),sample_size):
+            sizes.append(sum(map(len,record)))
+        if len(sizes) < sample_size:
+            # the whole file was read
+            return (len(sizes),float(file_size) / max(len(sizes),1))
+        bytes_per_read = float(position()) / len(sizes)
+    finally:
+        ip.close()
+    return (int(round(file_size / bytes_per_read)),bytes_per_read)
+
+def open_fastq_output(filename,bufsize=-1,mode='w'):
+    """Open a FASTQ file for writing, gzip-compressed if it ends in .gz"""
+    if filename.endswith('.gz'):   # favor speed over ratio for intermediates
+        return io.BufferedWriter(gzip.open(filename,mode+'b',1),max(bufsize,io.DEFAULT_BUFFER_SIZE))
+    return open(filename,mode,bufsize)
@@ -20,6 +20,8 @@ from numpy import log, log10, sum, pi
 from numpy.random import permutation
 from scipy.special import gammaln
 
+from countsio import is_counts_matrix, load_counts_matrix
+
 
 ############################
 #
@@ -631,6 +633,7 @@ if __name__ == '__main__':
     argparser.add_argument('--subsample', type=int, default=0)
     argparser.add_argument('--truth', action='store_true')
     argparser.add_argument('--verbose', action='store_true')
+    argparser.add_argument('--sample', default=None, help='output sample to use from a binary counts matrix (default: first)')
     args = argparser.parse_args()
 
     def msg(txt):
@@ -648,8 +651,13 @@ if __name__ == '__main__':
 
     # load data
     msg("Loading data...")
-    full_df = pd.read_csv(args.input, index_col=None)
-    full_df.columns = pd.Index(['clone', 'input', 'output'])
+    if is_counts_matrix(args.input):
+        (clones, input_counts, samples, counts) = load_counts_matrix(args.input)
+        j = 0 if args.sample is None else samples.index(args.sample)
+        full_df = pd.DataFrame({'clone': clones, 'input': input_counts, 'output': counts[j]}, columns=['clone', 'input', 'output'])
+    else:
+        full_df = pd.read_csv(args.input, index_col=None)
+        full_df.columns = pd.Index(['clone', 'input', 'output'])
     msg("finished\n")
 
     # subsample rows to make problem smaller
@@ -0,0 +1,54 @@
+# Per-sample stage manifests, so re-runs only redo samples whose inputs changed
+
+import os
+import json
+
+def file_signature(filename):
+    st = os.stat(filename)
+    return [st.st_size,int(st.st_mtime)]
+
+def output_exists(filename):
+    """Whether an output is present (empty files count as failed runs)"""
+    if os.path.isdir(filename):
+        return len(os.listdir(filename)) > 0
+    return os.path.exists(filename) and os.path.getsize(filename) > 0
+
+class Manifest(object):
+    """Record the inputs, parameters and outputs of every sample of a stage
+
+    Inputs are identified by their size and mtime.  A sample is up to date
+    when its inputs and parameters match the recorded ones and all of its
+    outputs exist.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.entries = {}
+        if os.path.exists(path):
+            with open(path,'r') as ip:
+                self.entries = json.load(ip)
+
+    def is_current(self, sample, inputs, params, outputs):
+        entry = self.entries.get(sample)
+        if entry is None:
+            return False
+        if entry['params'] != params or sorted(entry['outputs']) != sorted(outputs):
+            return False
+        for filename in inputs:
+            if not os.path.exists(filename) or entry['inputs'].get(filename) != file_signature(filename):
+                return False
+        return all(output_exists(filename) for filename in outputs)
+
+    def record(self, sample, inputs, params, outputs, job=None):
+        """Record a sample's run; `job` is the scheduler job ID producing its outputs, if any"""
+        self.entries[sample] = {'inputs'  : dict((filename,file_signature(filename)) for filename in inputs),
+                                'params'  : params,
+                                'outputs' : outputs}
+        if job is not None:
+            self.entries[sample]['job'] = job
+
+    def save(self):
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path,'w') as op:
+            json.dump(self.entries,op,indent=1,sort_keys=True)
+        os.rename(tmp_path,self.path)
@@ -14,6 +14,8 @@ import scipy.stats
 import pandas as pd
 import pymc
 
+from countsio import is_counts_matrix, load_counts_matrix
+
 def autocorrelation(x, normed=True):
     x = np.asarray(x)
     x -= x.mean()   # detrend
@@ -120,6 +122,7 @@ if __name__ == '__main__':
     argparser.add_argument('--subsample', type=int, default=0)
     argparser.add_argument('--truth', action='store_true')
     argparser.add_argument('--verbose', action='store_true')
+    argparser.add_argument('--samples', default=None, help='comma-separated output samples to use from a binary counts matrix (default: all)')
     args = argparser.parse_args()
     # args = argparser.parse_args('--input /Users/laserson/Dropbox/ElledgeLab/yifan/E7screenRawCount_input_end.csv --verbose --iterations 100000'.split())
     
@@ -138,7 +141,13 @@ if __name__ == '__main__':
     
     # load data
     msg("Loading data...")
-    full_df = pd.read_csv(args.input, index_col=None)
+    if is_counts_matrix(args.input):
+        (clones, input_counts, samples, counts) = load_counts_matrix(args.input)
+        js = range(len(samples)) if args.samples is None else [samples.index(s) for s in args.samples.split(',')]
+        full_df = pd.DataFrame(np.vstack([input_counts] + [counts[j] for j in js]).T)
+        full_df.insert(0, 'individual', clones)
+    else:
+        full_df = pd.read_csv(args.input, index_col=None)
     columns = ['individual'] + ['X_%i' % i for i in xrange(len(full_df.columns) - 1)]
     full_df.columns = pd.Index(columns)
     msg("finished\n")
@@ -11,6 +11,10 @@ import argparse
 import itertools
 import string
 
+import numpy as np
+
+from countsio import is_counts_matrix, load_counts_matrix
+
 header = lambda f: os.path.splitext(os.path.basename(f))[0]
 
 argparser = argparse.ArgumentParser(description=None)
@@ -23,6 +27,29 @@ input_dir = os.path.abspath(args.input)
 output_file = os.path.abspath(args.output)
 
 input_files = glob.glob(os.path.join(input_dir,'*.csv'))
+
+# binary counts matrices (*.mat) are merged column-wise without parsing text;
+# field 1 is the input count and field 2 onwards the sample columns
+input_matrices = filter(is_counts_matrix,glob.glob(os.path.join(input_dir,'*.mat')))
+if len(input_matrices) > 0:
+    if len(input_files) > 0:
+        argparser.error('input directory mixes CSV files and binary counts matrices')
+    join_column = None
+    columns = []
+    for matrix_dir in input_matrices:
+        (clones,input_counts,samples,counts) = load_counts_matrix(matrix_dir)
+        if join_column is None:
+            join_column = clones
+        else:
+            assert join_column == clones
+        columns.append(input_counts if args.field == 1 else counts[args.field-2])
+    merged = np.vstack(columns).T
+    with open(output_file,'w') as op:
+        print >>op, ','.join(['']+map(header,input_matrices))
+        for (clone,row) in itertools.izip(join_column,merged):
+            print >>op, ','.join([clone]+map(str,row.tolist()))
+    sys.exit()
+
 file_iterators = [open(f,'r') for f in input_files]
 file_headers = map(header,input_files)
 
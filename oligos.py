@@ -0,0 +1,55 @@
+# Library oligo sequences and the exact-match prefix hash used by exact_align.py
+#
+# The hash maps the first `prefix_len` bases of each oligo to (clone,oligo)
+# and is cached on disk with the library's size and mtime, so it is built
+# once per library rather than once per alignment job.
+
+import os
+import cPickle
+
+from manifest import file_signature
+
+def load_library(filename):
+    """Yield (clone,sequence) for each oligo of a FASTA file"""
+    (name,seq) = (None,[])
+    with open(filename,'r') as ip:
+        for line in ip:
+            if line.startswith('>'):
+                if name is not None:
+                    yield (name,''.join(seq).upper())
+                (name,seq) = (line[1:].split()[0],[])
+            else:
+                seq.append(line.strip())
+    if name is not None:
+        yield (name,''.join(seq).upper())
+
+def build_prefix_hash(library_file,prefix_len):
+    """Map each oligo prefix to (clone,oligo); prefixes shared by several oligos are left out"""
+    prefix2oligo = {}
+    ambiguous = set()
+    for (clone,oligo) in load_library(library_file):
+        prefix = oligo[:prefix_len]
+        if prefix in prefix2oligo:
+            ambiguous.add(prefix)
+        prefix2oligo[prefix] = (clone,oligo)
+    for prefix in ambiguous:
+        del prefix2oligo[prefix]
+    return prefix2oligo
+
+def load_prefix_hash(library_file,prefix_len,cache_file):
+    """Load the prefix hash from its on-disk cache, rebuilding it if the library changed"""
+    signature = [os.path.abspath(library_file),file_signature(library_file),prefix_len]
+    if os.path.exists(cache_file):
+        with open(cache_file,'rb') as ip:
+            if cPickle.load(ip) == signature:
+                return cPickle.load(ip)
+    prefix2oligo = build_prefix_hash(library_file,prefix_len)
+    tmp_file = '%s.%i.tmp' % (cache_file,os.getpid())
+    with open(tmp_file,'wb') as op:
+        cPickle.dump(signature,op,2)
+        cPickle.dump(prefix2oligo,op,2)
+    os.rename(tmp_file,cache_file)
+    return prefix2oligo
+
+def prefix_cache_file(library_file,prefix_len):
+    return '%s.exact%i.pkl' % (library_file,prefix_len)
@@ -3,24 +3,42 @@
 import os
 import argparse
 import glob
-import re
+import shutil
+import tempfile
+import multiprocessing
 
-bcre = re.compile(r'#(.*)/')
+from barcodes import load_barcodes, SampleWriter
 
-def hamming1(s):
-    s = s.upper()
-    alts = {'A':'CGTN','C':'AGTN','G':'ACTN','T':'ACGN'}
-    mutants = []
-    for i in range(len(s)):
-        for alt in alts[s[i]]:
-            mutant = s[:i] + alt + s[i+1:]
-            mutants.append(mutant)
-    return mutants
+def demultiplex_alns(infilenames,barcode2sample,writer):
+    for infilename in infilenames:
+        with open(infilename,'r') as ip:
+            for line in ip:
+                # read_name = line.split()[0]
+                # bc = bcre.search(read_name).group(1)
+                bc = line.split()[1].split(':')[-1]
+                try:
+                    sample = barcode2sample[bc]
+                except KeyError:
+                    continue
+                writer.write(sample,line)
+
+def demultiplex_worker(job):
+    """Demultiplex a chunk of parts into a private directory of sample files"""
+    (worker_dir,infilenames) = job
+    os.mkdir(worker_dir)
+    writer = sample_writer(worker_dir)
+    demultiplex_alns(infilenames,barcode2sample,writer)
+    writer.close()
+    return worker_dir
 
 argparser = argparse.ArgumentParser(description=None)
 argparser.add_argument('-i','--input',required=True)
 argparser.add_argument('-o','--output',required=True)
 argparser.add_argument('-m','--mapping',required=True)
+argparser.add_argument('-d','--distance',type=int,default=1,help='maximum barcode mismatches')
+argparser.add_argument('-j','--jobs',type=int,default=1,help='number of worker processes')
+argparser.add_argument('-b','--buffersize',type=int,default=256*1024*1024,help='output buffer size in bytes (per process)')
+argparser.add_argument('-f','--maxfiles',type=int,default=128,help='maximum number of open output files (per process)')
 args = argparser.parse_args()
 
 input_dir = os.path.abspath(args.input)
@@ -28,28 +46,33 @@ output_dir = os.path.abspath(args.output)
 os.makedirs(output_dir,mode=0755)
 mapping_file = args.mapping
 
-# load barcode mapping and open outhandles
-barcode2sample = {}
-outhandles = {}
-with open(mapping_file,'r') as ip:
-    for line in ip:
-        data = line.split()
-        bc = data[0]
-        sample = data[1]
-        barcode2sample[bc] = sample
-        for mut in hamming1(bc):
-            barcode2sample[mut] = sample
-        outhandles[sample] = open(os.path.join(output_dir,data[1]+'.aln'),'w')
-
-# iterate through alignments
-for infilename in glob.glob(os.path.join(input_dir,'*.aln')):
-    with open(infilename,'r') as ip:
-        for line in ip:
-            # read_name = line.split()[0]
-            # bc = bcre.search(read_name).group(1)
-            bc = line.split()[1].split(':')[-1]
-            try:
-                sample = barcode2sample[bc]
-            except KeyError:
-                continue
-            outhandles[sample].write(line)
+# load barcode mapping
+(barcode2sample,samples) = load_barcodes(mapping_file,args.distance)
+infilenames = glob.glob(os.path.join(input_dir,'*.aln'))
+sample_writer = lambda d: SampleWriter(dict((sample,os.path.join(d,sample+'.aln')) for sample in samples),args.buffersize,args.maxfiles)
+
+if args.jobs <= 1:
+    writer = sample_writer(output_dir)
+    demultiplex_alns(infilenames,barcode2sample,writer)
+    writer.close()
+else:
+    # each worker takes a contiguous chunk of parts, so concatenating the
+    # worker outputs in order gives the same files as a serial run
+    tmp_dir = tempfile.mkdtemp(dir=output_dir)
+    n = len(infilenames)
+    jobs = []
+    for k in xrange(args.jobs):
+        chunk = infilenames[k*n/args.jobs:(k+1)*n/args.jobs]
+        jobs.append((os.path.join(tmp_dir,str(k)),chunk))
+    pool = multiprocessing.Pool(args.jobs)
+    worker_dirs = pool.map(demultiplex_worker,jobs)
+    pool.close()
+    pool.join()
+    
+    # merge per-worker sample files
+    for sample in samples:
+        with open(os.path.join(output_dir,sample+'.aln'),'w') as op:
+            for worker_dir in worker_dirs:
+                with open(os.path.join(worker_dir,sample+'.aln'),'r') as ip:
+                    shutil.copyfileobj(ip,op,16*1024*1024)
+    shutil.rmtree(tmp_dir)
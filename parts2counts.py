@@ -0,0 +1,78 @@
+#! /usr/bin/env python
+
+# Demultiplex and count in one pass over the bowtie part outputs, skipping the
+# per-sample .aln files written by parts2barcodes.py
+
+import os
+import argparse
+import glob
+import multiprocessing
+
+from barcodes import load_barcodes
+from countsio import write_counts_csv
+
+def count_alns(infilenames):
+    counts = dict((sample,{}) for sample in samples)
+    for infilename in infilenames:
+        with open(infilename,'r') as ip:
+            for line in ip:
+                bc = line.split()[1].split(':')[-1]
+                try:
+                    sample = barcode2sample[bc]
+                except KeyError:
+                    continue
+                ref_clone = line.split('\t')[2].strip()
+                sample_counts = counts[sample]
+                sample_counts[ref_clone] = sample_counts.get(ref_clone,0) + 1
+    return counts
+
+argparser = argparse.ArgumentParser(description=None)
+argparser.add_argument('-i','--input',required=True)
+argparser.add_argument('-o','--output',required=True)
+argparser.add_argument('-m','--mapping',required=True)
+argparser.add_argument('-r','--refcounts',required=True)
+argparser.add_argument('-d','--distance',type=int,default=1,help='maximum barcode mismatches')
+argparser.add_argument('-s','--separated',action='store_true',help='write one <sample>.csv per sample into the output directory')
+argparser.add_argument('-j','--jobs',type=int,default=1,help='number of worker processes')
+args = argparser.parse_args()
+
+input_dir = os.path.abspath(args.input)
+output_path = os.path.abspath(args.output)
+if args.separated:
+    os.makedirs(output_path,mode=0755)
+reference_count_file = args.refcounts
+
+# load reference counts
+reference_names = []
+reference_counts = []
+with open(reference_count_file,'r') as ip:
+    for line in ip:
+        data = line.split(',')
+        reference_names.append(data[0].strip())
+        reference_counts.append(int(data[1]))
+
+# load barcode mapping
+(barcode2sample,samples) = load_barcodes(args.mapping,args.distance)
+
+# generate count dict
+infilenames = glob.glob(os.path.join(input_dir,'*.aln'))
+if args.jobs <= 1:
+    counts = count_alns(infilenames)
+else:
+    pool = multiprocessing.Pool(args.jobs)
+    partial_counts = pool.map(count_alns,[infilenames[k::args.jobs] for k in xrange(args.jobs)])
+    pool.close()
+    pool.join()
+    counts = partial_counts[0]
+    for other in partial_counts[1:]:
+        for sample in samples:
+            sample_counts = counts[sample]
+            for (ref_clone,count) in other[sample].iteritems():
+                sample_counts[ref_clone] = sample_counts.get(ref_clone,0) + count
+
+# output counts
+if args.separated:
+    for sample in samples:
+        write_counts_csv(os.path.join(output_path,"%s.csv" % sample),reference_names,reference_counts,[sample],counts)
+else:
+    write_counts_csv(output_path,reference_names,reference_counts,samples,counts)
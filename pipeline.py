@@ -0,0 +1,233 @@
+# Dependency-graph runner for the PhIP-seq pipeline scripts
+#
+# A pipeline is a list of Tasks, each a shell command with the names of the
+# tasks it depends on.  A task starts as soon as all of its dependencies have
+# finished, on an executor that either runs it in a local process pool or
+# submits it to SGE/LSF.  A task whose size is only known once its
+# dependencies have run (e.g. one alignment per part) has an `expand`
+# function instead of a command; it returns the subtasks, and the task
+# finishes when they have.
+#
+# Successful tasks are recorded in a Manifest, so re-running a pipeline skips
+# every task whose command and inputs are unchanged and whose outputs exist,
+# unless one of its dependencies had to be run again.  A task that is allowed
+# to fail does not stop its dependents, but an expanded task fails if none of
+# its subtasks succeeded.
+
+import os
+import sys
+import time
+import shutil
+import subprocess
+import multiprocessing
+
+from manifest import Manifest
+from scheduler import submit, job_id, active_jobs
+
+class Task(object):
+
+    def __init__(self, name, cmd=None, deps=(), inputs=(), outputs=(), log=None,
+                 expand=None, prepare=None, allow_failure=False):
+        self.name = name
+        self.cmd = cmd
+        self.deps = list(deps)
+        self.inputs = list(inputs)      # files whose size/mtime identify the run
+        self.outputs = list(outputs)    # removed before the task runs
+        self.log = log
+        self.expand = expand            # called once deps finish; returns subtasks
+        self.prepare = prepare          # called just before the command starts
+        self.allow_failure = allow_failure  # dependents still run if this fails
+
+def run_command(cmd,log_file):
+    with open(log_file,'w') as op:
+        return subprocess.call(cmd,shell=True,stdout=op,stderr=subprocess.STDOUT)
+
+class LocalExecutor(object):
+    """Run up to `jobs` task commands at a time in a local process pool"""
+
+    def __init__(self, jobs):
+        self.jobs = jobs
+        self.pool = multiprocessing.Pool(jobs)
+        self.running = {}
+
+    def has_slot(self):
+        return len(self.running) < self.jobs
+
+    def start(self, task):
+        self.running[task.name] = (task,self.pool.apply_async(run_command,(task.cmd,task.log)))
+
+    def poll(self):
+        finished = []
+        for (name,(task,result)) in self.running.items():
+            if result.ready():
+                del self.running[name]
+                finished.append((task,result.get()))
+        return finished
+
+    def close(self):
+        self.pool.close()
+        self.pool.join()
+
+class SchedulerExecutor(object):
+    """Submit every task command as its own SGE/LSF job
+
+    Each job runs a small shell script that writes the command's exit status
+    to <status_dir>/<task>.status, which is polled for completion.  A task
+    fails if it cannot be submitted, or if its job leaves the queue (e.g. it
+    was killed for exceeding its limits) without writing a status.
+    """
+
+    def __init__(self, scheduler, queue, status_dir, mem_usage=None):
+        self.scheduler = scheduler
+        self.queue = queue
+        self.status_dir = status_dir
+        self.mem_usage = mem_usage
+        self.running = {}
+        self.missing = {}   # consecutive polls each running job was not in the queue
+
+    def has_slot(self):
+        return True
+
+    def start(self, task):
+        script_file = os.path.join(self.status_dir,task.name+'.sh')
+        status_file = os.path.join(self.status_dir,task.name+'.status')
+        if os.path.exists(status_file):
+            os.remove(status_file)
+        with open(script_file,'w') as op:
+            print >>op, task.cmd
+            print >>op, 'echo $? > %s.tmp && mv %s.tmp %s' % (status_file,status_file,status_file)
+        try:
+            output = submit(self.scheduler,self.queue,task.log,'sh '+script_file,self.mem_usage,'phip_'+task.name)
+        except (OSError,IndexError):
+            output = ''
+        print output
+        job = job_id(self.scheduler,output)
+        if job is None:
+            sys.stderr.write("Could not submit %s\n" % task.name); sys.stderr.flush()
+        self.running[task.name] = (task,status_file,job)
+        self.missing[task.name] = 0
+
+    def poll(self):
+        finished = []
+        active = None
+        for (name,(task,status_file,job)) in self.running.items():
+            if os.path.exists(status_file):
+                del self.running[name]
+                with open(status_file,'r') as ip:
+                    finished.append((task,int(ip.read())))
+                continue
+            if job is None:
+                del self.running[name]
+                finished.append((task,-1))
+                continue
+            if active is None:
+                active = active_jobs(self.scheduler)
+                if active is None:
+                    break   # the queue cannot be listed right now; try again next poll
+            # only give up on a job once it has been missing from the queue on
+            # two polls in a row, to allow for the status file appearing late
+            self.missing[name] = 0 if job in active else self.missing[name] + 1
+            if self.missing[name] >= 2:
+                del self.running[name]
+                sys.stderr.write("Job %s for %s left the queue without an exit status\n" % (job,task.name)); sys.stderr.flush()
+                finished.append((task,-1))
+        return finished
+
+    def close(self):
+        pass
+
+def remove_outputs(task):
+    for filename in task.outputs:
+        if os.path.isdir(filename):
+            shutil.rmtree(filename)
+        elif os.path.exists(filename):
+            os.remove(filename)
+
+def run(tasks,executor,manifest_file,poll_interval=5):
+    """Run a list of tasks to completion
+
+    Returns the names of the failed (or skipped) tasks and of the tasks that
+    failed but were allowed to.
+    """
+    manifest = Manifest(manifest_file)
+    pending = list(tasks)
+    done = set()        # finished successfully (or allowed to fail)
+    failed = set()
+    allowed = set()     # failed, but allowed to
+    rerun = set()       # finished tasks that were actually run this time
+    forced = set()      # subtasks of an expansion whose dependencies were rerun
+    children = {}       # expanded task name -> names of its subtasks
+
+    def settle(name,ok,was_run):
+        (done if ok else failed).add(name)
+        if was_run:
+            rerun.add(name)
+
+    while pending or executor.running:
+        progress = False
+        for task in list(pending):
+            if any(dep in failed for dep in task.deps):
+                sys.stderr.write("Skipping %s: a dependency failed\n" % task.name); sys.stderr.flush()
+                pending.remove(task)
+                failed.add(task.name)
+                progress = True
+            elif task.name in children:
+                # an expanded task finishes with its subtasks
+                subtasks = children[task.name]
+                if all(name in done or name in failed for name in subtasks):
+                    pending.remove(task)
+                    was_run = any(name in rerun for name in subtasks + task.deps)
+                    ok = not any(name in failed for name in subtasks)
+                    if subtasks and all(name in allowed for name in subtasks):
+                        sys.stderr.write("Failed %s: none of its subtasks succeeded\n" % task.name); sys.stderr.flush()
+                        ok = False
+                    settle(task.name,ok,was_run)
+                    progress = True
+            elif all(dep in done for dep in task.deps):
+                deps_rerun = any(dep in rerun for dep in task.deps)
+                if task.expand is not None:
+                    subtasks = task.expand()
+                    if deps_rerun:
+                        forced.update(subtask.name for subtask in subtasks)
+                    children[task.name] = [subtask.name for subtask in subtasks]
+                    pending.extend(subtasks)
+                    progress = True
+                elif not deps_rerun and task.name not in forced and manifest.is_current(task.name,task.inputs,{'cmd':task.cmd},task.outputs):
+                    pending.remove(task)
+                    settle(task.name,True,False)
+                    progress = True
+                elif executor.has_slot():
+                    sys.stderr.write("Starting %s\n" % task.name); sys.stderr.flush()
+                    manifest.entries.pop(task.name,None)
+                    manifest.save()
+                    remove_outputs(task)
+                    if task.prepare is not None:
+                        task.prepare()
+                    executor.start(task)
+                    pending.remove(task)
+                    progress = True
+
+        for (task,returncode) in executor.poll():
+            progress = True
+            if returncode == 0:
+                sys.stderr.write("Finished %s\n" % task.name); sys.stderr.flush()
+                manifest.record(task.name,task.inputs,{'cmd':task.cmd},task.outputs)
+                manifest.save()
+                settle(task.name,True,True)
+            else:
+                sys.stderr.write("Failed %s (exit code %i, see %s)\n" % (task.name,returncode,task.log)); sys.stderr.flush()
+                settle(task.name,task.allow_failure,True)
+                if task.allow_failure:
+                    allowed.add(task.name)
+
+        if not progress:
+            if not executor.running:
+                # remaining tasks depend on tasks that will never exist
+                for task in pending:
+                    sys.stderr.write("Unresolved dependencies for %s\n" % task.name); sys.stderr.flush()
+                    failed.add(task.name)
+                break
+            time.sleep(poll_interval)
+
+    executor.close()
+    return (sorted(failed),sorted(allowed))
@@ -0,0 +1,147 @@
+#! /usr/bin/env python
+
+# Run the whole workflow (fastq2parts -> bowtie -> parts2barcodes -> counts ->
+# pvals [-> merge]) as one dependency graph, locally or on SGE/LSF.  Running
+# it again with the same arguments resumes after the last completed tasks.
+
+import os
+import sys
+import glob
+import argparse
+
+from bowtie import bowtie_shell_command
+from oligos import load_prefix_hash, prefix_cache_file
+from pipeline import Task, LocalExecutor, SchedulerExecutor, run
+
+argparser = argparse.ArgumentParser(description=None)
+argparser.add_argument('-i','--input',required=True,help='multiplexed FASTQ file')
+argparser.add_argument('-w','--workdir',required=True)
+argparser.add_argument('-x','--index',required=True)
+argparser.add_argument('-m','--mapping',required=True)
+argparser.add_argument('-r','--refcounts',required=True)
+argparser.add_argument('-p','--packetsize',type=int,default=5000000)
+argparser.add_argument('-l','--library',default=None,help='library oligo FASTA file; reads that exactly match an oligo skip bowtie')
+argparser.add_argument('--prefix',type=int,default=40,help='oligo prefix length hashed for --library')
+argparser.add_argument('-v','--virtual',action='store_true',help='align byte ranges of the input instead of copying parts')
+argparser.add_argument('-s','--separated',action='store_true',help='count and compute p-values per sample, then merge')
+argparser.add_argument('-e','--executor',choices=['local','SGE','LSF'],default='local')
+argparser.add_argument('-j','--jobs',type=int,default=1,help='number of concurrent local tasks, also passed to the stages that take -j')
+argparser.add_argument('-q','--queue',default=None)
+argparser.add_argument('--mem_usage',type=int,default=None,help='memory per scheduler job in GB')
+args = argparser.parse_args()
+
+if args.executor != 'local' and args.queue is None:
+    argparser.error('-q/--queue is required with the %s executor' % args.executor)
+
+script_dir = os.path.dirname(os.path.abspath(sys.argv[0]))
+input_file = os.path.abspath(args.input)
+index = os.path.abspath(args.index)
+mapping_file = os.path.abspath(args.mapping)
+reference_count_file = os.path.abspath(args.refcounts)
+
+workdir = os.path.abspath(args.workdir)
+parts_dir = os.path.join(workdir,'parts')
+alns_dir = os.path.join(workdir,'alns')
+barcodes_dir = os.path.join(workdir,'barcodes')
+log_dir = os.path.join(workdir,'logs')
+state_dir = os.path.join(workdir,'pipeline')
+for dir in [workdir,log_dir,state_dir]:
+    if not os.path.isdir(dir):
+        os.makedirs(dir,mode=0755)
+
+script = lambda name: 'python %s/%s' % (script_dir,name)
+log = lambda name: os.path.join(log_dir,name+'.log')
+
+bowtie_cmd = lambda reads,alignments: bowtie_shell_command(index,reads,alignments)
+range_cmd = script('bowtie_range.py') + ' -i %(reads)s -s %(offset)s -n %(length)s -x %(index)s -o %(alignments)s'
+if args.library is not None:
+    # exact matches are aligned by exact_align.py, which passes the rest on to bowtie
+    library_file = os.path.abspath(args.library)
+    load_prefix_hash(library_file,args.prefix,prefix_cache_file(library_file,args.prefix))   # build the cache before the jobs start
+    exact_cmd = script('exact_align.py') + ' -l %s -k %i -x %s' % (library_file,args.prefix,index)
+    bowtie_cmd = lambda reads,alignments: exact_cmd + ' -i %s -o %s' % (reads,alignments)
+    range_cmd = exact_cmd + ' -i %(reads)s -s %(offset)s -n %(length)s -o %(alignments)s'
+
+def align_tasks():
+    """One alignment task per part written by fastq2parts.py"""
+    if not os.path.isdir(alns_dir):
+        os.makedirs(alns_dir,mode=0755)
+    tasks = []
+    index_file = os.path.join(parts_dir,'parts.idx')
+    if os.path.exists(index_file):
+        with open(index_file,'r') as ip:
+            for line in ip:
+                if line.startswith('#'): continue
+                (basename,reads,offset,length,num_reads) = line.split('\t')
+                outfilename = os.path.join(alns_dir,basename+'.aln')
+                cmd = range_cmd % {'reads':reads,'offset':offset,'length':length,'index':index,'alignments':outfilename}
+                tasks.append(Task('align.'+basename,cmd,inputs=[reads],outputs=[outfilename],log=log('align.'+basename)))
+        return tasks
+    for infilename in sorted(glob.glob(os.path.join(parts_dir,'*.fastq')) + glob.glob(os.path.join(parts_dir,'*.fastq.gz'))):
+        basename = os.path.basename(infilename).split('.fastq')[0]
+        outfilename = os.path.join(alns_dir,basename+'.aln')
+        cmd = bowtie_cmd(infilename,outfilename)
+        tasks.append(Task('align.'+basename,cmd,inputs=[infilename],outputs=[outfilename],log=log('align.'+basename)))
+    return tasks
+
+def pvals_tasks():
+    """One p-value task per sample written by alns2counts_separated.py"""
+    if not os.path.isdir(pvals_dir):
+        os.makedirs(pvals_dir,mode=0755)
+    tasks = []
+    for infilename in sorted(glob.glob(os.path.join(counts_path,'*.csv')) + glob.glob(os.path.join(counts_path,'*.mat'))):
+        sample = '.'.join(os.path.basename(infilename).split('.')[:-1])
+        outfilename = os.path.join(pvals_dir,'.'.join([sample,'pvals','csv']))
+        cmd = script('counts2pvals.py') + ' -i %s -o %s' % (infilename,outfilename)
+        # a sample that fails (e.g. too few reads) is left out of the merge
+        tasks.append(Task('pvals.'+sample,cmd,inputs=[infilename],outputs=[outfilename],log=log('pvals.'+sample),allow_failure=True))
+    return tasks
+
+def remove_empty_pvals():
+    for filename in glob.glob(os.path.join(pvals_dir,'*.csv')):
+        if os.path.getsize(filename) == 0:
+            sys.stderr.write("Removing empty p-value file %s\n" % filename); sys.stderr.flush()
+            os.remove(filename)
+
+split_cmd = script('fastq2parts.py') + ' -i %s -o %s -p %i' % (input_file,parts_dir,args.packetsize)
+if args.virtual:
+    split_cmd += ' -v'
+demux_cmd = script('parts2barcodes.py') + ' -i %s -o %s -m %s -j %i' % (alns_dir,barcodes_dir,mapping_file,args.jobs)
+tasks = [Task('split',split_cmd,inputs=[input_file],outputs=[parts_dir],log=log('split')),
+         Task('align',deps=['split'],expand=align_tasks),
+         Task('demux',demux_cmd,deps=['align'],inputs=[mapping_file],outputs=[barcodes_dir],log=log('demux'))]
+
+if args.separated:
+    counts_path = os.path.join(workdir,'counts')
+    pvals_dir = os.path.join(workdir,'pvals')
+    pvals_file = os.path.join(workdir,'pvals.csv')
+    counts_cmd = script('alns2counts_separated.py') + ' -i %s -o %s -r %s -j %i' % (barcodes_dir,counts_path,reference_count_file,args.jobs)
+    merge_cmd = script('merge_columns.py') + ' -f 1 -i %s -o %s' % (pvals_dir,pvals_file)
+    tasks += [Task('counts',counts_cmd,deps=['demux'],inputs=[reference_count_file],outputs=[counts_path],log=log('counts')),
+              Task('pvals',deps=['counts'],expand=pvals_tasks),
+              Task('merge',merge_cmd,deps=['pvals'],outputs=[pvals_file],log=log('merge'),prepare=remove_empty_pvals)]
+else:
+    counts_path = os.path.join(workdir,'counts.csv')
+    pvals_file = os.path.join(workdir,'pvals.csv')
+    counts_cmd = script('alns2counts.py') + ' -i %s -o %s -r %s -j %i' % (barcodes_dir,counts_path,reference_count_file,args.jobs)
+    pvals_cmd = script('counts2pvals.py') + ' -i %s -o %s -j %i' % (counts_path,pvals_file,args.jobs)
+    tasks += [Task('counts',counts_cmd,deps=['demux'],inputs=[reference_count_file],outputs=[counts_path],log=log('counts')),
+              Task('pvals',pvals_cmd,deps=['counts'],outputs=[pvals_file],log=log('pvals'))]
+
+if args.executor == 'local':
+    executor = LocalExecutor(args.jobs)
+    poll_interval = 1
+else:
+    executor = SchedulerExecutor(args.executor,args.queue,state_dir,args.mem_usage)
+    poll_interval = 30
+
+(failed,allowed) = run(tasks,executor,os.path.join(state_dir,'manifest.json'),poll_interval)
+if allowed:
+    sys.stderr.write("%i tasks failed and were left out: %s\n" % (len(allowed),' '.join(allowed)))
+if failed:
+    sys.stderr.write("%i tasks failed or were skipped: %s\nRe-run the same command to resume.\n" % (len(failed),' '.join(failed)))
+    sys.exit(1)
+if allowed:
+    sys.stderr.write("Pipeline finished without them: %s\nRe-run the same command to retry them.\n" % pvals_file)
+else:
+    sys.stderr.write("Pipeline finished: %s\n" % pvals_file)
@@ -0,0 +1,104 @@
+# Job submission to the LSF and SGE schedulers, shared by the launcher scripts
+#
+# Besides one job per command, commands can be submitted as a single array
+# job: they are listed in a task file (see write_task_file) and every array
+# task runs its share of them through array_task.py.
+#
+# Memory requests (mem_usage) are in GB for both schedulers: SGE gets them as
+# h_vmem, LSF as an rusage reservation in MB (the default LSF_UNIT_FOR_LIMITS).
+
+import os
+import re
+import subprocess
+
+script_dir = os.path.dirname(os.path.abspath(__file__))
+
+def submit_to_LSF(queue,LSFopfile,cmd_to_submit,mem_usage=None,job_name=None):
+    # wrap command to submit in quotations
+    cmd_to_submit = r'"%s"' % cmd_to_submit.strip(r'"')
+    LSF_params = {'LSFoutput':LSFopfile,
+                      'queue':queue}
+    LSF_cmd = 'bsub -q%(queue)s -o%(LSFoutput)s' % LSF_params
+    if job_name != None:
+        LSF_cmd += r' -J "%s"' % job_name
+    if mem_usage != None:
+        LSF_cmd += r' -R "rusage[mem=%d]"' % (mem_usage * 1024)
+    cmd = ' '.join([LSF_cmd,cmd_to_submit])
+    p = subprocess.Popen(cmd,shell=True,stdout=subprocess.PIPE)
+    #p.wait()
+    return p.stdout.read().split('<')[1].split('>')[0]
+
+def submit_to_SGE(queue,log_file,cmd_to_submit,mem_usage=None,job_name='phip',options=''):
+    # wrap command to submit in quotations
+    cmd_to_submit = r'"%s"' % cmd_to_submit.strip(r'"')
+    SGE_params = {'log_output':log_file,
+                      'queue':queue}
+    SGE_cmd = 'qsub -o %(log_output)s -b y -V -j y -cwd -q %(queue)s' % SGE_params
+    SGE_cmd += ' -N %s' % job_name
+    if options:
+        SGE_cmd += ' ' + options
+    if mem_usage != None:
+        SGE_cmd += r' -l h_vmem=%dG' % mem_usage
+    cmd = ' '.join([SGE_cmd,cmd_to_submit])
+    print cmd
+    p = subprocess.Popen(cmd,shell=True,stdout=subprocess.PIPE)
+    #p.wait()
+    return p.stdout.read()
+
+def write_task_file(filename,tasks,pack=1):
+    """Write a task file for an array job and return its number of array tasks
+
+    `tasks` is a list of (log_file,command) pairs; `pack` consecutive
+    commands are run one after another by each array task.
+    """
+    with open(filename,'w') as op:
+        print >>op, '# task\tlog\tcommand'
+        for (i,(log_file,cmd)) in enumerate(tasks):
+            print >>op, '%i\t%s\t%s' % (i // pack + 1,log_file,cmd)
+    return (len(tasks) + pack - 1) // pack
+
+def submit_array(scheduler,queue,log_dir,task_file,num_tasks,mem_usage=None,job_name='phip',options='',max_running=None):
+    """Submit every task of a task file as one array job
+
+    The scheduler's own output for each array task goes to
+    <log_dir>/<job_name>.<task>.log; each command logs to its own file.
+    At most `max_running` array tasks run at once, if given.
+    """
+    cmd = 'python %s/array_task.py -f %s' % (script_dir,os.path.abspath(task_file))
+    if scheduler == 'LSF':
+        log_file = "'%s'" % os.path.join(log_dir,job_name+'.%I.log')
+        array_name = '%s[1-%i]' % (job_name,num_tasks)
+        if max_running != None:
+            array_name += '%%%i' % max_running
+        return submit_to_LSF(queue,log_file,cmd,mem_usage,job_name=array_name)
+    log_file = "'%s'" % os.path.join(log_dir,job_name+'.$TASK_ID.log')
+    options = ('%s -t 1-%i' % (options,num_tasks)).strip()
+    if max_running != None:
+        options += ' -tc %i' % max_running
+    return submit_to_SGE(queue,log_file,cmd,mem_usage,job_name,options)
+
+def submit(scheduler,queue,log_file,cmd_to_submit,mem_usage=None,job_name='phip',options=''):
+    if scheduler == 'LSF':
+        return submit_to_LSF(queue,log_file,cmd_to_submit,mem_usage,job_name)
+    return submit_to_SGE(queue,log_file,cmd_to_submit,mem_usage,job_name,options)
+
+def job_id(scheduler,submit_output):
+    """The job ID in the output of submit(), or None if submission failed"""
+    if scheduler == 'LSF':
+        return submit_output.strip() or None
+    match = re.search(r'Your job(?:-array)? (\d+)',submit_output)
+    return match.group(1) if match else None
+
+def active_jobs(scheduler):
+    """IDs of the user's queued and running jobs, or None if they cannot be listed"""
+    cmd = ['bjobs','-w'] if scheduler == 'LSF' else ['qstat']
+    try:
+        p = subprocess.Popen(cmd,stdout=subprocess.PIPE,stderr=subprocess.PIPE)
+    except OSError:
+        return None
+    (output,errors) = p.communicate()
+    if p.returncode != 0 and not (scheduler == 'LSF' and 'No unfinished job' in errors):
+        return None
+    # both list one job per line after the header, with the ID first
+    return set(line.split()[0] for line in output.splitlines() if line.strip() and line.split()[0].isdigit())
+
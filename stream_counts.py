@@ -0,0 +1,121 @@
+#! /usr/bin/env python
+
+# Align, demultiplex and count in one streaming pass on a single node: the
+# FASTQ file is fed to bowtie's stdin and its alignments are consumed from
+# stdout as they are produced, so no parts or .aln files are written (unless
+# -a asks for the per-sample alignments too)
+
+import os
+import sys
+import argparse
+import threading
+import subprocess
+
+from barcodes import load_barcodes, SampleWriter
+from bowtie import bowtie_command, bowtie_env
+from countsio import write_counts_csv
+from fastqio import open_fastq
+
+def feed_reads(infilename,stdin,errors):
+    """Copy the reads into bowtie's stdin; runs in its own thread
+
+    Any exception is stored in `errors` for the main thread to re-raise.
+    """
+    try:
+        ip = open_fastq(infilename,args.buffersize,args.threads)
+        try:
+            while True:
+                chunk = ip.read(args.buffersize)
+                if not chunk: break
+                stdin.write(chunk)
+        finally:
+            ip.close()
+    except Exception:
+        errors.append(sys.exc_info())
+    finally:
+        stdin.close()
+
+def stream_alignments(infilename):
+    """Yield bowtie's alignment lines for a FASTQ file as they are produced
+
+    Raises once bowtie's output ends if reading the input or bowtie failed,
+    so no counts are written from a partial run.
+    """
+    bowtie_cmd = bowtie_command(args.index,'-',threads=args.threads)
+    p = subprocess.Popen(bowtie_cmd,stdin=subprocess.PIPE,stdout=subprocess.PIPE,env=bowtie_env(args.index),bufsize=args.buffersize)
+    errors = []
+    feeder = threading.Thread(target=feed_reads,args=(infilename,p.stdin,errors))
+    feeder.daemon = True
+    feeder.start()
+    for line in p.stdout:
+        yield line
+    feeder.join()
+    if p.wait() != 0:
+        raise subprocess.CalledProcessError(p.returncode,' '.join(bowtie_cmd))
+    if errors:
+        (exc_type,exc_value,exc_traceback) = errors[0]
+        raise exc_type, exc_value, exc_traceback
+
+argparser = argparse.ArgumentParser(description=None)
+argparser.add_argument('-i','--input',required=True,help='multiplexed FASTQ file (may be gzipped)')
+argparser.add_argument('-o','--output',required=True)
+argparser.add_argument('-x','--index',required=True)
+argparser.add_argument('-m','--mapping',required=True)
+argparser.add_argument('-r','--refcounts',required=True)
+argparser.add_argument('-d','--distance',type=int,default=1,help='maximum barcode mismatches')
+argparser.add_argument('-s','--separated',action='store_true',help='write one <sample>.csv per sample into the output directory')
+argparser.add_argument('-a','--alns',default=None,help='also write the per-sample alignments into this directory')
+argparser.add_argument('-t','--threads',type=int,default=4,help='bowtie and decompression threads')
+argparser.add_argument('-b','--buffersize',type=int,default=4*1024*1024,help='pipe buffer size in bytes')
+argparser.add_argument('-w','--writebuffer',type=int,default=256*1024*1024,help='per-sample alignment output buffer size in bytes (with -a)')
+argparser.add_argument('-f','--maxfiles',type=int,default=128,help='maximum number of open alignment files (with -a)')
+args = argparser.parse_args()
+
+output_path = os.path.abspath(args.output)
+if args.separated:
+    os.makedirs(output_path,mode=0755)
+reference_count_file = args.refcounts
+
+# load reference counts
+reference_names = []
+reference_counts = []
+with open(reference_count_file,'r') as ip:
+    for line in ip:
+        data = line.split(',')
+        reference_names.append(data[0].strip())
+        reference_counts.append(int(data[1]))
+
+# load barcode mapping
+(barcode2sample,samples) = load_barcodes(args.mapping,args.distance)
+
+writer = None
+if args.alns is not None:
+    alns_dir = os.path.abspath(args.alns)
+    os.makedirs(alns_dir,mode=0755)
+    writer = SampleWriter(dict((sample,os.path.join(alns_dir,sample+'.aln')) for sample in samples),args.writebuffer,args.maxfiles)
+
+# generate count dict while bowtie runs
+counts = dict((sample,{}) for sample in samples)
+num_alns = 0
+for line in stream_alignments(args.input):
+    num_alns += 1
+    bc = line.split()[1].split(':')[-1]
+    try:
+        sample = barcode2sample[bc]
+    except KeyError:
+        continue
+    ref_clone = line.split('\t')[2].strip()
+    sample_counts = counts[sample]
+    sample_counts[ref_clone] = sample_counts.get(ref_clone,0) + 1
+    if writer is not None:
+        writer.write(sample,line)
+if writer is not None:
+    writer.close()
+sys.stderr.write("Counted %i alignments\n" % num_alns); sys.stderr.flush()
+
+# output counts
+if args.separated:
+    for sample in samples:
+        write_counts_csv(os.path.join(output_path,"%s.csv" % sample),reference_names,reference_counts,[sample],counts)
+else:
+    write_counts_csv(output_path,reference_names,reference_counts,samples,counts)